@@ -74,7 +74,7 @@ def main(state):
       if success:
         f, fallback = an.from_frame(f)
         t1.image(cvt(f))
-        t2.image(fallback)
+        t2.image(fallback.img)
       else:
         break
     cap.release()
@@ -93,7 +93,7 @@ def main(state):
 
     def simplecam(frame):
       f = frame.to_ndarray(format='bgr24')
-      return VideoFrame.from_ndarray(an.from_frame(f)[1])
+      return VideoFrame.from_ndarray(an.from_frame(f)[1].img)
 
     # oh my god, it took me so long to realize the frame bigger through time
     def cam(frame):
@@ -149,7 +149,7 @@ def main(state):
           if an.unneeded:
             t1, t2 = t2, t1
           t1.image(cvt(f))
-          t2.image(fallback)
+          t2.image(fallback.img)
           t1.progress(count / total_frames)
           count += 1
 
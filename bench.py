@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+import json
+import os
+import platform
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from inspect import Parameter
+from multiprocessing import Pool, get_context
+from pathlib import Path
+from subprocess import run
+from time import perf_counter, strftime
+
+import cv2
+import numpy as np
+import torch
+from attrs import asdict
+from supervision import Detections
+from typer import Option, Typer
+from ultralytics.engine.results import Results
+from vidgear.gears import WriteGear
+
+from core import Annotator, all_class, all_default, all_names, all_plain
+from fish2pano import FisheyeWarping, MeshCache
+from model import EXPORTS, Model, ModelInfo, coconames, registry
+from utils import ColorClassifier, Draw, FisheyeFlatten, avg_rgb, box_colors, color_dict
+
+app = Typer()
+
+
+def timed(fn, *args, **kwargs):
+  start = perf_counter()
+  out = fn(*args, **kwargs)
+  return out, perf_counter() - start
+
+
+def read_frames(source: str, n: int) -> list[np.ndarray]:
+  cap = cv2.VideoCapture(source)
+  frames = []
+  while len(frames) < n and (f := cap.read()[1]) is not None:
+    frames.append(f)
+  cap.release()
+  return frames
+
+
+def legacy_dewarp_job(point):
+  y, x, img_details = point
+  w_d, h_d, r1, r2, c_x, c_y = img_details
+  r = (float(y) / float(h_d)) * (r2 - r1) + r1
+  theta = (float(x) / float(w_d)) * 2.0 * np.pi
+  x_s = int(c_x + r * np.sin(theta))
+  y_s = int(c_y + r * np.cos(theta))
+  return (y, x), x_s, y_s
+
+
+def legacy_dewarp_map(warping: FisheyeWarping, img):
+  img_details = warping.get_fisheye_img_data(img)
+  w_d, h_d, _, _, _, _ = img_details
+  mapx = np.zeros((h_d, w_d), np.float32)
+  mapy = np.zeros((h_d, w_d), np.float32)
+
+  jobList = []
+  for y in range(int(h_d - 1)):
+    jobList.extend((y, x, img_details) for x in range(int(w_d - 1)))
+  with Pool() as p:
+    results = p.map(legacy_dewarp_job, jobList)
+  for (y, x), x_s, y_s in results:
+    mapx[y, x] = x_s
+    mapy[y, x] = y_s
+
+  return mapx, mapy
+
+
+def legacy_unit_vector(vector):
+  np.seterr(invalid='ignore')
+  norm = np.linalg.norm(vector)
+  return vector / norm
+
+
+def legacy_angle_between(v1, v2):
+  v1_u = legacy_unit_vector(v1)
+  v2_u = legacy_unit_vector(v2)
+  return np.arccos(np.clip(np.dot(v1_u, v2_u), -1.0, 1.0))
+
+
+def legacy_angle_map(points):
+  point, center, top_point, radius = points
+  point_np = np.asarray(point)
+  distance = np.linalg.norm(point_np - center)
+  length_percent = None
+  if distance <= radius:
+    angle = legacy_angle_between(top_point - center, point_np - center)
+    length_percent = angle / (2 * np.pi)
+  return point, length_percent, distance
+
+
+def legacy_rewarp_map(warping: FisheyeWarping):
+  width, height, _ = warping.img.shape
+  xmap = np.zeros((width, height), dtype=np.float32)
+  ymap = np.zeros((width, height), dtype=np.float32)
+  mask = np.zeros((width, height), dtype=np.uint8)
+  center = np.asarray([int(width / 2), int(height / 2)])
+  top_point = np.asarray([int(width / 2), 0])
+  radius = width / 2
+  jobs = []
+  for y, channel in enumerate(warping.img):
+    for x, _ in enumerate(channel):
+      points = ((x, y), center, top_point, radius)
+      jobs.append(points)
+  with Pool() as p:
+    results = p.map(legacy_angle_map, jobs)
+  pano_w = warping.get_fisheye_img_data(warping.img)[0]
+  for (x, y), length_percentage, distance in results:
+    if length_percentage is not None:
+      xmap[y, x] = length_percentage * pano_w
+      ymap[y, x] = distance
+      mask[y, x] = 255
+
+  return xmap, ymap, mask
+
+
+@app.command()
+def dewarp(size: int = 720, chunk_rows: int = 0, legacy: bool = True):
+  img = np.zeros((size, size, 3), np.uint8)
+  warping = FisheyeWarping(img)
+
+  (mapx, mapy), t = timed(warping.build_dewarp_map, img, chunk_rows or None)
+  print(f'vectorized: {t:.3f}s {mapx.shape}')
+
+  if legacy:
+    (ref_x, ref_y), t_ref = timed(legacy_dewarp_map, warping, img)
+    same = np.array_equal(mapx, ref_x) and np.array_equal(mapy, ref_y)
+    print(f'per-pixel pool: {t_ref:.3f}s ({t_ref / t:.0f}x slower), identical: {same}')
+
+
+@app.command()
+def rewarp(size: int = 720, legacy: bool = True):
+  img = np.zeros((size, size, 3), np.uint8)
+  warping = FisheyeWarping(img)
+
+  (xmap, ymap, mask), t = timed(warping.build_rewarp_map)
+  print(f'vectorized: {t:.3f}s {xmap.shape}')
+
+  if legacy:
+    (ref_x, ref_y, ref_mask), t_ref = timed(legacy_rewarp_map, warping)
+    # raises on mismatch; NaN at the exact center compares equal
+    np.testing.assert_array_equal(xmap, ref_x)
+    np.testing.assert_array_equal(ymap, ref_y)
+    np.testing.assert_array_equal(mask, ref_mask)
+    print(f'per-pixel pool: {t_ref:.3f}s ({t_ref / t:.0f}x slower), identical: True')
+
+
+@app.command()
+def mesh_cache(size: int = 2880, root: str = 'mesh_cache', fixed_point: bool = False):
+  img = np.zeros((size, size, 3), np.uint8)
+  cache = MeshCache(root, fixed_point=fixed_point)
+  for attempt in ('first', 'second'):
+    warping = FisheyeWarping(img, cache)
+    _, t_dewarp = timed(warping.build_dewarp_mesh)
+    _, t_rewarp = timed(warping.build_rewarp_mesh)
+    print(f'{attempt} start: dewarp {t_dewarp:.3f}s, rewarp {t_rewarp:.3f}s')
+
+
+@app.command()
+def fused_rewarp(size: int = 1440, frames: int = 20):
+  img = np.random.default_rng(0).integers(0, 256, (size, size, 3), np.uint8)
+  warping = FisheyeWarping(img)
+  warping.build_dewarp_mesh()
+  warping.build_rewarp_mesh()
+  pano = warping.dewarp(img)
+
+  ref, t_ref = timed(lambda: [warping.rewarp(pano.copy(), flip=True) for _ in range(frames)])
+  out, t = timed(lambda: [warping.rewarp(pano, flip=True, fused=True) for _ in range(frames)])
+  diff = np.abs(out[-1].astype(int) - ref[-1]).max()
+  print(f'two remaps + add + rotate: {t_ref / frames * 1e3:.2f}ms/frame')
+  print(f'fused remap: {t / frames * 1e3:.2f}ms/frame ({t_ref / t:.1f}x faster)')
+  print(f'max abs diff: {diff}')
+
+  ref, t_ref = timed(lambda: [warping.run_rewarp_with_mesh(pano) for _ in range(frames)])
+  out, t = timed(lambda: [warping.run_rewarp_with_mesh(pano, fused=True) for _ in range(frames)])
+  diff = np.abs(out[-1].astype(int) - ref[-1]).max()
+  print(f'rotate + two remaps + add + rotate: {t_ref / frames * 1e3:.2f}ms/frame')
+  print(f'fused pre-rotated remap: {t / frames * 1e3:.2f}ms/frame ({t_ref / t:.1f}x faster)')
+  print(f'max abs diff: {diff}')
+
+
+def legacy_flatten(flattener: FisheyeFlatten, f):
+  return cv2.undistort(
+    f[flattener.slic],
+    flattener.camera_matrix,
+    flattener.dist_coeffs,
+    None,
+    flattener.new_camera_matrix,
+  )[flattener.crop]
+
+
+@app.command()
+def flatten(width: int = 3840, height: int = 2160, frames: int = 50, fixed_point: bool = True):
+  f = np.random.default_rng(0).integers(0, 256, (height, width, 3), np.uint8)
+  flattener = FisheyeFlatten((width, height), fixed_point=fixed_point, reuse_buffer=True)
+
+  _, t_ref = timed(lambda: [legacy_flatten(flattener, f) for _ in range(frames)])
+  _, t = timed(lambda: [flattener(f) for _ in range(frames)])
+  diff = np.abs(flattener(f).astype(int) - legacy_flatten(flattener, f)).max()
+  print(f'undistort: {t_ref / frames * 1e3:.2f}ms/frame')
+  print(f'remap: {t / frames * 1e3:.2f}ms/frame ({t_ref / t:.1f}x faster), max abs diff: {diff}')
+
+
+@app.command()
+def backends(
+  source: str,
+  weights: str = 'yolov8n.pt',
+  frames: int = 200,
+  imgsz: int = 640,
+  warmup: int = 5,
+):
+  clip = read_frames(source, frames)
+  for backend in ('torch', *EXPORTS):
+    model = Model(ModelInfo(path=weights, backend=backend, imgsz=imgsz))
+    for f in clip[:warmup]:
+      model.from_frame(f)
+    latency = []
+    boxes = 0
+    for f in clip:
+      (det, _), t = timed(model.from_frame, f)
+      latency.append(t)
+      boxes += len(det)
+    ms = np.array(latency) * 1e3
+    print(
+      f'{backend:>12}: {len(clip) / ms.sum() * 1e3:6.1f} fps, p50 {np.median(ms):.1f}ms, '
+      f'p90 {np.percentile(ms, 90):.1f}ms, {boxes / len(clip):.1f} boxes/frame'
+    )
+
+
+@app.command()
+def imports(runs: int = 5):
+  # fresh interpreters each run, so nothing is already in sys.modules
+  probe = "import sys; print('streamlit' in sys.modules, 'torch' in sys.modules)"
+  cases = {
+    'import utils': ['-c', f'import utils; {probe}'],
+    'import model': ['-c', f'import model; {probe}'],
+    'import core': ['-c', f'import core; {probe}'],
+    'native.py --help': ['native.py', '--help'],
+  }
+  for name, args in cases.items():
+    outs = [
+      timed(run, [sys.executable, *args], check=True, capture_output=True, text=True)
+      for _ in range(runs)
+    ]
+    loaded = outs[0][0].stdout.split() if args[0] == '-c' else ['-', '-']
+    print(
+      f'{name:>16}: {np.median([t for _, t in outs]):.2f}s median of {runs}, '
+      f'streamlit loaded: {loaded[0]}, torch loaded: {loaded[1]}'
+    )
+
+
+@app.command()
+def colors(width: int = 1920, height: int = 1080, objects: int = 40, frames: int = 20):
+  scene = Scene((width, height), objects)
+  exact = ColorClassifier(list(color_dict), lut_bits=0)
+  clip = [(scene.render(t), scene.boxes(t).astype(int)) for t in range(frames)]
+
+  def per_box(f, xyxy):
+    return [exact.closest(avg_rgb(f[y1:y2, x1:x2])) for x1, y1, x2, y2 in xyxy]
+
+  ref, t_ref = timed(lambda: [per_box(f, xyxy) for f, xyxy in clip])
+  print(f'per-box kmeans + closest: {t_ref / frames * 1e3:.2f}ms/frame')
+  for bits in (0, 5, 6):
+    clf = ColorClassifier(list(color_dict), lut_bits=bits)
+    for method in ('kmeans', 'median', 'mean'):
+      out, t = timed(
+        lambda clf=clf, method=method: [
+          clf.classify(box_colors(f, xyxy, method)[0]) for f, xyxy in clip
+        ]
+      )
+      same = np.mean([np.mean(np.array(a) == b) for a, b in zip(ref, out)])
+      print(
+        f'lut bits {bits} {method:>6}: {t / frames * 1e3:.2f}ms/frame ({t_ref / t:.1f}x), '
+        f'{same:.1%} agree'
+      )
+    f = clip[0][0][..., ::-1]
+    _, t = timed(clf.classify, f)
+    print(f'lut bits {bits} every pixel: {t * 1e3:.2f}ms/frame')
+
+
+@app.command()
+def lut(bits: int = 6, samples: int = 100_000, seed: int = 0):
+  # the table must give the exact class at every cell centre, and mostly agree in between
+  exact = ColorClassifier(list(color_dict))
+  clf = ColorClassifier(list(color_dict), lut_bits=bits)
+  shift = 8 - bits
+  centres = (np.arange(1 << bits) << shift) + ((1 << shift) >> 1)
+  grid = np.stack(np.meshgrid(centres, centres, centres, indexing='ij'), axis=-1)
+  sample = np.random.default_rng(seed).integers(0, 256, (samples, 3))
+  on_centres = np.array_equal(clf.classify(grid), exact.classify(grid))
+  agree = np.mean(clf.classify(sample) == exact.classify(sample))
+  print(f'lut bits {bits}: exact on cell centres: {on_centres}, {agree:.2%} of {samples} agree')
+
+
+@app.command()
+def hud(width: int = 1920, height: int = 1080, objects: int = 40, frames: int = 300):
+  from supervision import Color, Point, draw_text
+
+  from custom_annotator import CountAnnotator, FpsAnnotator
+
+  scene = Scene((width, height), objects)
+  f = scene.render(0)
+  det = scene.detections(0)
+  count = CountAnnotator(names=coconames)
+  fps = FpsAnnotator()
+
+  def direct():
+    for i, c in enumerate(np.bincount(det.class_id)):
+      if c:
+        draw_text(f, f'{c} {coconames[i]}s', Point(x=width - 50, y=12 + i * 9), Color.black())
+    draw_text(f, '30.00', Point(x=50, y=20), Color.black(), text_scale=1.0)
+
+  _, t_ref = timed(lambda: [direct() for _ in range(frames)])
+  _, t = timed(lambda: [fps.annotate(count.annotate(f, det), det) for _ in range(frames)])
+  print(f'draw_text every frame: {t_ref / frames * 1e3:.3f}ms/frame')
+  print(f'count sprite + fps text: {t / frames * 1e3:.3f}ms/frame ({t_ref / t:.1f}x faster)')
+
+
+@app.command()
+def labels(
+  width: int = 1920,
+  height: int = 1080,
+  objects: int = 40,
+  frames: int = 300,
+  scale: float = 0.5,
+  thickness: int = 1,
+  padding: int = 1,
+):
+  from supervision import LabelAnnotator
+
+  from core import format_labels
+
+  scene = Scene((width, height), objects)
+  rng = np.random.default_rng(0)
+  dets = [scene.detections(t) for t in range(frames)]
+  for det in dets:
+    # detector confidences wander from frame to frame
+    det.confidence = rng.uniform(0.3, 1.0, len(det)).astype(np.float32)
+  f = scene.render(0)
+  label = LabelAnnotator(text_scale=scale, text_thickness=thickness, text_padding=padding)
+  registry.put(StubNet(scene), 'stub')
+  an = Annotator(Model(ModelInfo(path='stub')), {'Label': label})
+  names = an.names
+
+  def per_row(det):
+    text = [
+      f'{conf:0.2f} {names[cl]}' + (f' {track_id}' if track_id else '')
+      for conf, cl, track_id in zip(det.confidence, det.class_id, det.tracker_id)
+    ]
+    return label.annotate(f, det, labels=text)
+
+  _, t_ref = timed(lambda: [per_row(det) for det in dets])
+  _, t_cols = timed(
+    lambda: [label.annotate(f, det, labels=format_labels(det, an.name_table)) for det in dets]
+  )
+  print(f'per-row labels + LabelAnnotator: {t_ref / frames * 1e3:.3f}ms/frame')
+  print(f'column labels + LabelAnnotator: {t_cols / frames * 1e3:.3f}ms/frame')
+  print(f'speedup: {t_ref / t_cols:.1f}x')
+
+
+@app.command()
+def lines(lines: int = 20, tracks: int = 100, frames: int = 300, side: int = 640):
+  import supervision
+  from supervision import LineZone, Point
+
+  from custom_annotator import LineSet
+
+  rng = np.random.default_rng(1)
+  ref = [
+    LineZone(Point(*rng.integers(0, side, 2).tolist()), Point(*rng.integers(0, side, 2).tolist()))
+    for _ in range(lines)
+  ]
+  ours = [LineZone(line.vector.start, line.vector.end) for line in ref]
+  lineset = LineSet(ours)
+
+  # tracks drift across the frame, drop out now and then and come in any order
+  pos = rng.random((tracks, 2)) * side
+  velocity = rng.normal(0, side / 80, (tracks, 2))
+  ids = np.arange(1, tracks + 1)
+  dets = []
+  for _ in range(frames):
+    pos += velocity
+    keep = rng.random(tracks) < 0.8
+    xy = pos[keep]
+    wh = rng.random((len(xy), 2)) * side / 20 + 5
+    det = Detections(
+      xyxy=np.hstack([xy, xy + wh]).astype(np.float32),
+      class_id=np.zeros(len(xy), int),
+      tracker_id=ids[keep],
+    )
+    dets.append(det[rng.permutation(len(det))])
+
+  flags_ref, t_ref = timed(lambda: [[line.trigger(det) for line in ref] for det in dets])
+  flags, t = timed(lambda: [lineset.trigger(det) for det in dets])
+  same = all(
+    (np.array([i for i, _ in a]) == b[0]).all() and (np.array([o for _, o in a]) == b[1]).all()
+    for a, b in zip(flags_ref, flags)
+  ) and all(a.in_count == b.in_count and a.out_count == b.out_count for a, b in zip(ref, ours))
+  print(f'supervision {supervision.__version__}')
+  print(f'LineZone.trigger per line: {t_ref / frames * 1e3:.3f}ms/frame')
+  print(f'LineSet.trigger: {t / frames * 1e3:.3f}ms/frame ({t_ref / t:.1f}x faster)')
+  print(f'same crossings and counts: {same}')
+
+
+@app.command()
+def zones(width: int = 1280, height: int = 720, boxes: int = 200, seed: int = 0):
+  # ZoneSet against one PolygonZone per zone, within and past the 64 bits of one label image
+  from supervision import PolygonZone
+
+  from custom_annotator import ZoneSet
+
+  rng = np.random.default_rng(seed)
+  xy = rng.uniform(-0.1, 1.1, (boxes, 2)) * (width, height)
+  det = Detections(xyxy=np.hstack([xy, xy + rng.uniform(5, 200, (boxes, 2))]))
+  for n in (0, 9, 64, 80):
+    centre = rng.uniform(0, 1, (n, 1, 2)) * (width, height)
+    polygons = (centre + rng.uniform(-150, 150, (n, 5, 2))).astype(np.int32)
+    zoneset = ZoneSet(list(polygons), (width, height))
+    ref = [PolygonZone(p, (width, height)).trigger(det) for p in polygons]
+    flags = zoneset.trigger(det)
+    same = flags.shape == (n, boxes) and np.array_equal(flags, np.reshape(ref, (n, boxes)))
+    store = zoneset.labels if zoneset.masks is None else zoneset.masks
+    print(f'{n} zones: same as PolygonZone: {same}, {getattr(store, "nbytes", 0) / 1e6:.1f} MB')
+
+
+@app.command()
+def stride(every: int = 2, frames: int = 20, width: int = 640, height: int = 480):
+  # pose and classify show the fallback as the main view, skipped frames must keep a real image
+  scene = Scene((width, height), 10)
+  for task in ('pose', 'classify'):
+    registry.put(StubNet(scene), 'stub')
+    camera = Annotator(Model(ModelInfo(path='stub', task=task, stride=every)))
+    video = Model(ModelInfo(path='stub', task=task, stride=every))
+    camera.model.fallback = video.fallback = True
+    shapes = set()
+    for t in range(frames):
+      f = scene.render(t)
+      shapes.add(camera.from_frame(f.copy())[1].img.shape)
+      shapes.add(video.infer_batch([[f]])[0][1][1].img.shape)
+    print(f'{task}, detect every {every}: fallback shapes {sorted(shapes)}')
+
+
+@app.command()
+def forks(frames: int = 4, size: int = 320):
+  # a tracked and an untracked Model on one registry net, the untracked one must see plain
+  # predictions, as a net of its own would give
+  from ultralytics import YOLO
+
+  rng = np.random.default_rng(0)
+  clip = [rng.integers(0, 256, (size, size, 3), np.uint8) for _ in range(frames)]
+  info = dict(path='yolov8n.yaml', conf=0.01, classes=list(range(80)))
+  tracked = Model(ModelInfo(tracker='bytetrack', **info))
+  plain = tracked.fork(ModelInfo(**info))
+  # untrained weights, every anchor scores high so there are boxes to track
+  for conv in tracked.net.model.model[-1].cv3:
+    conv[-1].bias.data.fill_(2.0)
+  own = YOLO('yolov8n.yaml')
+  own.model.load_state_dict(tracked.net.model.state_dict())
+
+  same = True
+  for f in clip:
+    tracked.from_frame(f)
+    det, _ = plain.from_frame(f)
+    ref = own.predict(f, conf=0.01, iou=0.5, verbose=False)[0].boxes.xyxy.numpy()
+    same &= det.tracker_id is None and det.xyxy.shape == ref.shape and np.allclose(det.xyxy, ref)
+  ids = tracked.from_frame(clip[0])[0].tracker_id
+  print(f'untracked fork matches its own net: {same}, tracked fork keeps ids: {ids is not None}')
+
+
+@app.command()
+def exported_names(backend: str = 'onnxruntime', root: str = 'bench_data', imgsz: int = 160):
+  # exported weights with their own classes must not fall back to the COCO names
+  import torch
+  from ultralytics import YOLO
+
+  names = {0: 'apple', 1: 'pear', 2: 'plum'}
+  net = YOLO('yolov8n.yaml').model
+  net.names = names
+  weights = Path(root) / 'fruit.pt'
+  weights.parent.mkdir(parents=True, exist_ok=True)
+  torch.save({'model': net, 'train_args': {'task': 'detect'}}, weights)
+  model = Model(ModelInfo(path=str(weights), backend=backend, imgsz=imgsz))
+  print(f'{backend} names: {model.names}, match: {model.names == names}')
+
+
+class Scene:
+  # shapes bouncing at constant speed, every frame is a pure function of its index
+  def __init__(self, reso: tuple[int, int], objects: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    side = min(reso)
+    self.reso = reso
+    self.size = rng.integers(side // 16, side // 6, (objects, 2))
+    self.span = np.array(reso) - self.size
+    self.start = rng.random((objects, 2)) * self.span
+    self.velocity = rng.uniform(-1, 1, (objects, 2)) * side / 90
+    self.class_id = rng.integers(0, 3, objects)
+    self.colors = rng.integers(64, 256, (objects, 3)).tolist()
+
+  def boxes(self, t: int) -> np.ndarray:
+    p = (self.start + self.velocity * t) % (2 * self.span)
+    p = self.span - np.abs(p - self.span)
+    return np.hstack([p, p + self.size]).astype(np.float32)
+
+  @staticmethod
+  def shape(img: np.ndarray, box: np.ndarray, class_id: int, color):
+    x1, y1, x2, y2 = box
+    if class_id % 2:
+      cv2.ellipse(img, (((x1 + x2) / 2, (y1 + y2) / 2), (x2 - x1, y2 - y1), 0), color, -1)
+    else:
+      cv2.rectangle(img, (x1, y1), (x2, y2), color, -1)
+
+  def render(self, t: int) -> np.ndarray:
+    w, h = self.reso
+    f = np.full((h, w, 3), 32, np.uint8)
+    for box, c, color in zip(self.boxes(t).astype(int).tolist(), self.class_id, self.colors):
+      self.shape(f, box, c, color)
+    return f
+
+  def detections(self, t: int, masks: bool = False) -> Detections:
+    xyxy = self.boxes(t)
+    n = len(xyxy)
+    mask = None
+    if masks:
+      w, h = self.reso
+      mask = np.zeros((n, h, w), np.uint8)
+      for m, box, c in zip(mask, xyxy.astype(int).tolist(), self.class_id):
+        self.shape(m, box, c, 1)
+      mask = mask.astype(bool)
+    return Detections(
+      xyxy=xyxy,
+      mask=mask,
+      confidence=np.full(n, 0.9, np.float32),
+      class_id=self.class_id,
+      tracker_id=np.arange(1, n + 1),
+    )
+
+
+class StubNet:
+  # hands out the scene's ground truth in frame order, so no network runs
+  def __init__(self, scene: Scene, masks: bool = False):
+    self.scene = scene
+    self.masks = masks
+    self.names = coconames
+    self.t = 0
+
+  def predict(self, source, track: bool = False, **_) -> list[Results]:
+    results = []
+    for f in source if isinstance(source, list) else [source]:
+      det = self.scene.detections(self.t, self.masks)
+      ids = [det.tracker_id] if track else []
+      boxes = np.column_stack([det.xyxy, *ids, det.confidence, det.class_id])
+      results.append(
+        Results(
+          f,
+          path='',
+          names=self.names,
+          boxes=torch.from_numpy(boxes.astype(np.float32)),
+          masks=None if det.mask is None else torch.from_numpy(det.mask),
+        )
+      )
+      self.t += 1
+    return results
+
+  def track(self, source, **kwargs) -> list[Results]:
+    return self.predict(source, track=True, **kwargs)
+
+
+def synth_video(scene: Scene, frames: int, root: str = 'bench_data') -> str:
+  w, h = scene.reso
+  path = Path(root) / f'synth-{w}x{h}-{len(scene.size)}-{frames}.mp4'
+  if not path.exists():
+    path.parent.mkdir(parents=True, exist_ok=True)
+    out = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), 30, (w, h))
+    for t in range(frames):
+      out.write(scene.render(t))
+    out.release()
+  return str(path)
+
+
+def clocked(it) -> list[float]:
+  latency = []
+  start = perf_counter()
+  for _ in it:
+    now = perf_counter()
+    latency.append(now - start)
+    start = now
+  return latency
+
+
+def build_annotator(name: str, reso: tuple[int, int]):
+  w, h = reso
+  kwargs = {k: v for k, v in all_default()[name].items() if v is not Parameter.empty}
+  match name:
+    case 'Count':
+      kwargs['names'] = coconames
+    case 'LineAndZone':
+      kwargs['reso'] = reso
+      kwargs['draw'] = Draw(
+        lines=[((0, h // 2), (w, h // 2))],
+        zones=[[[w // 4, h // 4], [w // 2, h // 4], [w // 2, h * 3 // 4], [w // 4, h * 3 // 4]]],
+      )
+  return all_class[name](**kwargs)
+
+
+def run_case(case: str, reso: tuple[int, int], objects: int, frames: int, video: str, saveto: str):
+  scene = Scene(reso, objects)
+  kind, _, name = case.partition(':')
+  match kind:
+    case 'model':
+      registry.put(StubNet(scene, masks=True), 'stub', task='segment')
+      model = Model(ModelInfo(path='stub', task='segment', tracker='bytetrack'))
+      latency = clocked(model(video))
+    case 'annotator':
+      ann = build_annotator(name, reso)
+      masks = name in ('Halo', 'Mask', 'Polygon')
+      latency = [
+        timed(ann.annotate, scene.render(t), scene.detections(t, masks))[1] for t in range(frames)
+      ]
+    case 'preprocess' if name == 'FisheyeFlatten':
+      flattener = FisheyeFlatten(reso, reuse_buffer=True)
+      latency = [timed(flattener, scene.render(t))[1] for t in range(frames)]
+    case 'preprocess' if name == 'FisheyeWarping':
+      side = min(reso)
+      warping = FisheyeWarping(np.empty((side, side, 3), np.uint8))
+      warping.build_dewarp_mesh()
+      warping.build_rewarp_mesh()
+
+      def roundtrip(f):
+        return warping.rewarp(warping.dewarp(f), flip=True, fused=True)
+
+      latency = [timed(roundtrip, scene.render(t)[:side, :side])[1] for t in range(frames)]
+    case 'native':
+      # the threaded `native.py --saveto` path: config load, pipeline, WriteGear
+      registry.put(StubNet(scene), 'stub')
+      plain = deepcopy(all_plain())
+      config = {k: plain[k] for k in ('BoxCorner', 'Count', 'Fps', 'Label', 'Trace')}
+      config['Count']['names'] = coconames
+      path = Path(saveto).with_suffix('.json')
+      export = {
+        'reso': reso,
+        'preprocessors': [],
+        'config': config,
+        'model': asdict(ModelInfo(path='stub', tracker='bytetrack')),
+      }
+      path.write_text(json.dumps(export))
+      an = Annotator.load(str(path))
+      writer = WriteGear(output=saveto)
+      latency = clocked(an.stream(video, sink=writer.write))
+      writer.close()
+      path.unlink()
+    case _:
+      raise ValueError(f'unknown case {case}')
+
+  ms = np.array(latency) * 1e3
+  return {
+    'frames': len(ms),
+    'fps': round(len(ms) / ms.sum() * 1e3, 2),
+    'p50_ms': round(np.percentile(ms, 50), 3),
+    'p90_ms': round(np.percentile(ms, 90), 3),
+    'p99_ms': round(np.percentile(ms, 99), 3),
+    # kilobytes on linux
+    'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+  }
+
+
+@app.command()
+def suite(
+  out: str = 'bench.json',
+  reso: list[str] = Option(['640x480', '1920x1080'], help='WIDTHxHEIGHT, repeatable'),
+  objects: list[int] = Option([4, 32], help='Shapes per frame, repeatable'),
+  frames: int = 100,
+  only: str = Option('', help='Only run cases whose name contains this'),
+  root: str = 'bench_data',
+):
+  cases = [
+    'model:gen',
+    *(f'annotator:{i}' for i in sorted(all_names)),
+    'preprocess:FisheyeFlatten',
+    'preprocess:FisheyeWarping',
+    'native:save',
+  ]
+  results = []
+  for r in reso:
+    wh = tuple(map(int, r.split('x')))
+    for n in objects:
+      video = synth_video(Scene(wh, n), frames, root)
+      saveto = str(Path(root) / f'out-{r}-{n}.mp4')
+      for case in cases:
+        # preprocessors do not care about the object count
+        if only not in case or (case.startswith('preprocess') and n != objects[0]):
+          continue
+        # a fresh interpreter per case, so peak RSS is not carried over from earlier ones
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as ex:
+          res = ex.submit(run_case, case, wh, n, frames, video, saveto).result()
+        results.append({'case': case, 'reso': r, 'objects': n, **res})
+        print(
+          f'{case:>28} {r:>9} x{n:<3}: {res["fps"]:8.1f} fps, p50 {res["p50_ms"]:.2f}ms, '
+          f'p99 {res["p99_ms"]:.2f}ms, rss {res["peak_rss_mb"]:.0f}MB'
+        )
+
+  meta = {
+    'time': strftime('%Y-%m-%dT%H:%M:%S%z'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'opencv': cv2.__version__,
+    'torch': torch.__version__,
+    'frames': frames,
+  }
+  Path(out).write_text(json.dumps({'meta': meta, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+  app()
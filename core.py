@@ -1,15 +1,14 @@
 import json
 from copy import deepcopy
+from functools import cache
 from inspect import signature
 from pathlib import Path
 from typing import Generator
 
 import numpy as np
-import streamlit as st
 from attrs import asdict
 from numpy import ndarray
 from PIL import Image
-from streamlit import sidebar as sb
 from supervision import (
   BlurAnnotator,
   BoundingBoxAnnotator,
@@ -32,6 +31,7 @@ from supervision import (
   TriangleAnnotator,
   VideoInfo,
 )
+from vidgear.gears import VideoGear
 
 from custom_annotator import (
   AreaAnnotator,
@@ -40,12 +40,18 @@ from custom_annotator import (
   CountAnnotator,
   FpsAnnotator,
   LineAndZoneAnnotator,
+  TimingAnnotator,
 )
-from model import Model, ModelInfo
+from model import Fallback, Model, ModelInfo
+from pipeline import Pipeline
 from utils import (
   FisheyeFlatten,
+  FisheyePanorama,
+  Profiler,
+  batched,
   canvas2draw,
   color_dict,
+  color_methods,
   exe_button,
   first_frame,
   from_plain,
@@ -75,6 +81,7 @@ all_anns = {
   MaskAnnotator,
   PixelateAnnotator,
   PolygonAnnotator,
+  TimingAnnotator,
   TraceAnnotator,
   TriangleAnnotator,
 }
@@ -82,27 +89,52 @@ all_anns = {
 
 all_class = {i.__name__[:-9]: i for i in all_anns}
 all_names = list(all_class.keys())
-all_default = {}
-
-for i in all_names:
-  sig = {}
-  for j in signature(all_class[i]).parameters.items():
-    sig |= {j[0]: j[1].default}
-  all_default[i] = sig
-
 custom_defaults = {
   'text_padding': 1,
   'text_thickness': 1,
   'thickness': 1,
 }
 
-for v in all_default.values():
-  for k, d in custom_defaults.items():
-    if k in v:
-      v[k] = d
+
+@cache
+def all_default() -> dict:
+  defaults = {}
+  for i in all_names:
+    sig = {}
+    for j in signature(all_class[i]).parameters.items():
+      sig |= {j[0]: j[1].default}
+    for k, d in custom_defaults.items():
+      if k in sig:
+        sig[k] = d
+    defaults[i] = sig
+  return defaults
+
+
+@cache
+def all_plain() -> dict:
+  return to_plain(all_default())
+
+
+def name_table(names: dict | list) -> ndarray:
+  if isinstance(names, dict):
+    return np.array([str(names.get(i, i)) for i in range(max(names, default=-1) + 1)])
+  return np.array([str(i) for i in names])
 
 
-all_plain = to_plain(all_default)
+def format_labels(det: Detections, table: ndarray) -> list[str]:
+  # `f'{conf:0.2f} {name} {track_id}'` for every row at once, from whole columns
+  if not len(det):
+    return []
+  cls = det.class_id
+  names = cls.astype(str)
+  if len(table):
+    known = cls < len(table)
+    names = np.where(known, table[np.where(known, cls, 0)], names)
+  labels = np.char.add(np.char.add(np.char.mod('%0.2f', det.confidence), ' '), names)
+  if det.tracker_id is not None:
+    ids = np.char.add(' ', det.tracker_id.astype(str))
+    labels = np.char.add(labels, np.where(det.tracker_id != 0, ids, ''))
+  return labels.tolist()
 
 
 class Annotator:
@@ -118,6 +150,7 @@ class Annotator:
       del anns['Label']
     else:
       self.label = None
+    self.name_table = name_table(self.names)
 
     if 'Trace' in anns:
       self.trace = anns['Trace']
@@ -130,33 +163,50 @@ class Annotator:
       self.linezone: LineAndZoneAnnotator = anns['LineAndZone']
 
     self.anns = anns
+    self.pipeline: Pipeline | None = None
+    self.profiler: Profiler | None = None
+    if 'Timing' in anns:
+      self.profile(anns['Timing'].profiler)
 
   @classmethod
-  def load(cls, path: str):
+  def load(cls, path: str, model: Model | None = None):
     d = json.load(open(path))
-    model = Model(ModelInfo(**d['model']))
+    info = ModelInfo(**d['model'])
+    # a given model only lends its weights, settings come from this config
+    model = Model(info) if model is None else model.fork(info)
     config = from_plain(d['config'])
     preprocessors = d['preprocessors']
     if 'FisheyeFlatten' in preprocessors:
       model.preprocessors.append(FisheyeFlatten(d['reso']))
+    if 'FisheyePanorama' in preprocessors:
+      model.preprocessors.append(FisheyePanorama())
     anns = {i: all_class[i](**config[i]) for i in config}
     return cls(model, anns)
 
+  def profile(self, profiler: Profiler | None = None) -> Profiler:
+    # annotate methods are swapped for timed ones, unprofiled runs keep the originals
+    if self.profiler is not None:
+      return self.profiler
+    self.profiler = profiler = profiler or Profiler()
+    self.draw_labels = profiler.wrap('annotate/Label', self.draw_labels)
+    for k, v in (('Trace', self.trace), *self.anns.items()):
+      if v is not None:
+        v.annotate = profiler.wrap(f'annotate/{k}', v.annotate)
+      if isinstance(v, TimingAnnotator):
+        v.profiler = profiler
+    self.model.profile(profiler)
+    return profiler
+
+  def draw_labels(self, f: ndarray, det: Detections) -> ndarray:
+    return self.label.annotate(f, det, labels=format_labels(det, self.name_table))
+
   def __call__(
     self,
     f: ndarray,
     det: Detections,
   ) -> ndarray:  # sourcery skip: low-code-quality
-    names = self.names
     if self.label:
-      f = self.label.annotate(
-        f,
-        det,
-        labels=[
-          f'{conf:0.2f} {names[cl] if len(names) else cl}' + (f' {track_id}' if track_id else '')
-          for _, _, conf, cl, track_id in det
-        ],
-      )
+      f = self.draw_labels(f, det)
     if self.trace:
       try:
         f = self.trace.annotate(f, det)
@@ -167,16 +217,65 @@ class Annotator:
       f = v.annotate(f, det)
     return f
 
-  def gen(self, source: str | int) -> Generator:
-    for f, (det, fallback) in self.model(source):
+  def gen(self, source: str | int, batch: int = 1) -> Generator:
+    for f, (det, fallback) in self.model(source, batch):
       yield self(f, det), fallback
 
-  def from_frame(self, f: ndarray) -> tuple[ndarray, ndarray]:
+  def stream(
+    self,
+    source: str | int,
+    maxsize: int = 4,
+    sink: callable = None,
+    batch: int = 1,
+  ) -> Generator:
+    # every stage handles a list of `batch` frames
+    def preprocess(frames):
+      return [self.model.preprocess(f) for f in frames]
+
+    def annotate(items):
+      return [(self(f, det), fallback) for f, (det, fallback) in items]
+
+    def write(items):
+      for f, _ in items:
+        sink(f)
+      return items
+
+    stages = [
+      ('preprocess', preprocess),
+      ('infer', self.model.infer_batch),
+      ('annotate', annotate),
+    ]
+    if sink is not None:
+      stages.append(('write', write))
+
+    stream = VideoGear(source=source).start()
+    read = stream.read
+    if self.profiler is not None:
+      # `infer` is timed around the network call itself, see `Model.profile`
+      stages = [(k, v if k == 'infer' else self.profiler.wrap(k, v)) for k, v in stages]
+      read = self.profiler.wrap('decode', read)
+    self.pipeline = Pipeline(stages, maxsize)
+
+    try:
+      for items in self.pipeline(batched(iter(read, None), batch)):
+        yield from items
+    finally:
+      stream.stop()
+
+  def from_frame(self, f: ndarray) -> tuple[ndarray, Fallback]:
+    # the camera path skips `infer_batch`, so the stride is applied here
+    stride = self.model.stride
+    if stride.skip():
+      return self(f, stride.extrapolate()), stride.fallback
     det, fallback = self.model.from_frame(f)
+    stride.update(det, fallback)
     return self(f, det), fallback
 
   @classmethod
   def ui(cls, source: str | int):  # sourcery skip: low-code-quality
+    import streamlit as st
+    from streamlit import sidebar as sb
+
     if source:
       model = Model.ui()
       reso = VideoInfo.from_video_path(source).resolution_wh
@@ -216,6 +315,9 @@ class Annotator:
       model.preprocessors.append(flattener)
       preprocessors.append('FisheyeFlatten')
       background = Image.fromarray(flattener(np.array(background)))
+    if ex0.toggle('Fisheye Panorama', help='Detect on the dewarped panorama, draw on fisheye'):
+      model.preprocessors.append(FisheyePanorama())
+      preprocessors.append('FisheyePanorama')
 
     names = model.names
     task = model.task
@@ -241,8 +343,7 @@ class Annotator:
 
     ann_names = sb.multiselect('Annotators', all_names, base_anns)
 
-    # config_plain = all_plain
-    origin_config_plain = {k: v for k, v in all_plain.items() if k in ann_names}
+    origin_config_plain = {k: v for k, v in all_plain().items() if k in ann_names}
 
     config_plain = deepcopy(origin_config_plain)
 
@@ -284,10 +385,22 @@ class Annotator:
           case str(k2) if '_color' in k2:
             v[k2] = ex.color_picker(tit, v2, key=key)
 
+          case 'method':
+            v[k2] = ex.selectbox(tit, color_methods, color_methods.index(v2), key=key)
+
+          case 'lut_bits':
+            v[k2] = ex.select_slider(
+              'Lookup table bits',
+              (0, 4, 5, 6, 7, 8),
+              v2,
+              key=key,
+              help='0 classifies exactly, fewer bits trade accuracy for a smaller table',
+            )
+
         match v2:
           case bool():
             v[k2] = ex.toggle(tit, v2, key=key)
-          case int():
+          case int() if k2 != 'lut_bits':
             abso = abs(v2)
             min_val = min([0, v2, 10 * v2 + 1])
             max_val = max([0, abso, 10 * abso + 1])
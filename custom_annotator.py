@@ -1,4 +1,8 @@
+from collections import OrderedDict
+
+import cv2
 import numpy as np
+from attrs import define
 from numpy import ndarray
 from supervision import (
   Color,
@@ -8,15 +12,40 @@ from supervision import (
   LineZone,
   LineZoneAnnotator,
   Point,
-  PolygonZone,
   PolygonZoneAnnotator,
-  crop_image,
+  Position,
   draw_text,
   get_polygon_center,
 )
 from supervision.annotators.base import BaseAnnotator
+from supervision.detection.utils import clip_boxes
+from supervision.geometry.core import Vector
+
+from utils import (
+  ColorClassifier,
+  Draw,
+  Profiler,
+  Sprite,
+  SpriteCache,
+  box_colors,
+  plur,
+  text_size,
+)
+
+
+class TrackColor:
+  __slots__ = ('label', 'seen', 'updated', 'votes')
 
-from utils import ColorClassifier, Draw, avg_rgb, plur
+  def __init__(self, classes: int):
+    self.votes = np.zeros(classes)
+    self.label = -1
+    self.updated = -1
+    self.seen = -1
+
+  def vote(self, label: int, weight: float, frame: int):
+    self.votes[label] += weight
+    self.label = int(self.votes.argmax())
+    self.updated = frame
 
 
 class ColorClassifierAnnotator(BaseAnnotator):
@@ -24,47 +53,86 @@ class ColorClassifierAnnotator(BaseAnnotator):
     self,
     color_clf: ColorClassifier = ColorClassifier(),
     naive: bool = False,
+    method: str = 'mean',
+    refresh: int = 10,
+    ttl: int = 30,
+    lut_bits: int = 0,
     text_color: Color = Color.black(),
     text_scale: float = 0.5,
     text_thickness: int = 1,
     text_padding: int = 10,
   ):
     self.naive: bool = naive
+    self.method: str = method
+    self.refresh: int = refresh
+    self.ttl: int = ttl
     self.text_color: Color = text_color
     self.text_scale: float = text_scale
     self.text_thickness: int = text_thickness
     self.text_padding: int = text_padding
+    self.tracks: dict[int, TrackColor] = {}
+    self.frame = 0
     if color_clf.names:
       self.rgb_colors = color_clf.rgb
       self.color_names = color_clf.names or []
-      self.color_clf = color_clf
+      # the default classifier is shared between instances, the table setting is per annotator
+      self.color_clf = ColorClassifier(color_clf.names, lut_bits)
+
+  def colors(self, scene: ndarray, xyxy: ndarray) -> tuple[ndarray, ndarray]:
+    if self.naive:
+      h, w = scene.shape[:2]
+      x = np.clip((xyxy[:, 0] + xyxy[:, 2]) // 2, 0, w - 1)
+      y = np.clip((xyxy[:, 1] + xyxy[:, 3]) // 2, 0, h - 1)
+      return scene[y, x, ::-1].astype(np.float32), np.ones(len(xyxy), bool)
+    return box_colors(scene, xyxy, self.method)
+
+  def classify(self, scene: ndarray, xyxy: ndarray) -> tuple[ndarray, ndarray]:
+    rgbs, valid = self.colors(scene, xyxy)
+    return (self.color_clf.classify(rgbs) if len(rgbs) else np.zeros(0, int)), valid
+
+  def cached(self, scene: ndarray, detections: Detections) -> tuple[ndarray, ndarray]:
+    # tracks are re-estimated every `refresh` frames and labelled by the confidence-weighted
+    # vote so far, steady tracks cost a dict lookup between refreshes
+    frame = self.frame
+    ids = detections.tracker_id.tolist()
+    conf = detections.confidence
+    conf = [1.0] * len(ids) if conf is None else conf.tolist()
+    tracks = [self.tracks.get(i) for i in ids]
+    due = [k for k, t in enumerate(tracks) if t is None or frame - t.updated >= self.refresh]
+    if due:
+      predicts, valid = self.classify(scene, detections.xyxy[due].astype(int))
+      for k, p, ok in zip(due, predicts.tolist(), valid.tolist()):
+        if tracks[k] is None:
+          tracks[k] = self.tracks[ids[k]] = TrackColor(len(self.rgb_colors))
+        if ok:
+          tracks[k].vote(p, conf[k], frame)
+
+    for t in tracks:
+      t.seen = frame
+    # swept every `ttl` frames, a lost track lives between one and two `ttl`
+    if frame % max(self.ttl, 1) == 0:
+      self.tracks = {i: t for i, t in self.tracks.items() if frame - t.seen < self.ttl}
+    labels = np.array([t.label for t in tracks], int)
+    return labels, labels >= 0
 
   def annotate(
     self,
     scene: ndarray,
     detections: Detections,
   ) -> ndarray:
+    self.frame += 1
     xyxy = detections.xyxy.astype(int)
     centers = (xyxy[:, [0, 1]] + xyxy[:, [2, 3]]) // 2
 
-    for center, bb in zip(centers, xyxy):
-      x = center[0]
-      y = center[1]
-
-      # for shirt color of person
-      # w = bb[2] - bb[0]
-      # h = bb[3] - bb[1]
-      # cropped = f[
-      #     bb[1] : bb[3] - int(h * 0.4),
-      #     bb[0] + int(w * 0.2) : bb[2] - int(w * 0.2),
-      # ]
+    # colors are read for all boxes before any label is drawn over the scene
+    if detections.tracker_id is None or self.refresh < 1:
+      predicts, valid = self.classify(scene, xyxy)
+    else:
+      predicts, valid = self.cached(scene, detections)
 
-      cropped = crop_image(scene, bb)
-      if 0 in cropped.shape:
+    for (x, y), predict, ok in zip(centers, predicts, valid):
+      if not ok:
         continue
-
-      rgb = scene[y, x] if self.naive else avg_rgb(cropped)
-      predict = self.color_clf.closest(rgb)
       r, g, b = self.rgb_colors[predict]
       draw_text(
         scene=scene,
@@ -114,6 +182,50 @@ class FpsAnnotator(BaseAnnotator):
     return scene
 
 
+class TimingAnnotator(BaseAnnotator):
+  def __init__(
+    self,
+    profiler: Profiler | None = None,
+    text_anchor: Point = Point(x=160, y=50),
+    text_color: Color = Color.black(),
+    text_scale: float = 0.5,
+    text_thickness: int = 1,
+    text_padding: int = 1,
+    top: int = 8,
+  ):
+    self.profiler = profiler
+    self.text_anchor: Point = text_anchor
+    self.text_color: Color = text_color
+    self.text_scale: float = text_scale
+    self.text_thickness: int = text_thickness
+    self.text_padding: int = text_padding
+    self.top: int = top
+
+  def annotate(
+    self,
+    scene: ndarray,
+    detections: Detections,
+  ) -> ndarray:
+    if self.profiler is None:
+      return scene
+    summary = self.profiler.summary()
+    slowest = sorted(summary, key=lambda k: summary[k]['p50_ms'], reverse=True)[: self.top]
+    for i, k in enumerate(slowest):
+      draw_text(
+        scene=scene,
+        text=f'{k} {summary[k]["p50_ms"]:.1f} / {summary[k]["p99_ms"]:.1f} ms',
+        text_anchor=Point(
+          x=self.text_anchor.x,
+          y=self.text_anchor.y + int(i * self.text_scale * 36),
+        ),
+        text_color=self.text_color,
+        text_scale=self.text_scale,
+        text_thickness=self.text_thickness,
+        text_padding=self.text_padding,
+      )
+    return scene
+
+
 class CountAnnotator(BaseAnnotator):
   def __init__(
     self,
@@ -131,32 +243,45 @@ class CountAnnotator(BaseAnnotator):
     self.text_thickness: int = text_thickness
     self.text_padding: int = text_padding
     self.pallet: ColorPalette = ColorPalette.default()
+    self.sprites = SpriteCache(64)
+
+  def render(self, counts: tuple[int, ...]) -> Sprite:
+    names = self.names
+    step = self.text_scale * 18
+    lines = [(int(i * step), i, plur(c, names[i])) for i, c in enumerate(counts) if c]
+
+    def draw(f: ndarray, anchor: Point):
+      for dy, i, text in lines:
+        bg = self.pallet.by_idx(i)
+        draw_text(
+          scene=f,
+          text=text,
+          text_anchor=Point(x=anchor.x, y=anchor.y + dy),
+          text_color=Color.white() if np.sum(bg.as_bgr()) < 384 else Color.black(),
+          text_scale=self.text_scale,
+          text_thickness=self.text_thickness,
+          text_padding=self.text_padding,
+          background_color=bg,
+        )
+
+    sizes = [
+      text_size(text, self.text_scale, self.text_thickness, self.text_padding) for *_, text in lines
+    ]
+    # lines hang below the anchor, the canvas is centred on it
+    w = max(w for w, _ in sizes)
+    h = max(h for _, h in sizes) + 2 * lines[-1][0]
+    return Sprite(draw, (w, h))
 
   def annotate(
     self,
     scene: ndarray,
     detections: Detections,
   ) -> ndarray:
-    names = self.names
-    if len(names):
-      class_ids = detections.class_id
-
-      for i, c in enumerate(np.bincount(class_ids)):
-        if c:
-          bg = self.pallet.by_idx(i)
-          draw_text(
-            scene=scene,
-            text=plur(c, names[i]),
-            text_anchor=Point(
-              x=scene.shape[1] - self.text_anchor.x,
-              y=self.text_anchor.y + int(i * self.text_scale * 18),
-            ),
-            text_color=Color.white() if np.sum(bg.as_bgr()) < 384 else Color.black(),
-            text_scale=self.text_scale,
-            text_thickness=self.text_thickness,
-            text_padding=self.text_padding,
-            background_color=bg,
-          )
+    if len(self.names) and len(detections):
+      # every line in one sprite, a frame with the same counts is a single blit
+      counts = tuple(np.bincount(detections.class_id).tolist())
+      sprite = self.sprites.get(counts, lambda: self.render(counts))
+      sprite.blit(scene, Point(x=scene.shape[1] - self.text_anchor.x, y=self.text_anchor.y))
     return scene
 
 
@@ -193,7 +318,116 @@ class AreaAnnotator(BaseAnnotator):
     return scene
 
 
+class LineSet:
+  # supervision 0.17 LineZone.trigger for every line at once: a box takes a side only when its four
+  # corners agree (cross product < 0 is in), a change of side against the last one counts
+  def __init__(self, lines: list[LineZone]):
+    self.lines = lines
+    self.ids = np.empty(0, np.int64)
+    self.state = np.full((len(lines), 0), -1, np.int8)
+    self.scale(lines)
+
+  def scale(self, lines: list[LineZone]):
+    # geometry only, sides seen so far are kept
+    self.lines = lines
+    vectors = [line.vector for line in lines]
+    ends = np.array([[(v.start.x, v.start.y), (v.end.x, v.end.y)] for v in vectors], float)
+    ends = ends.reshape(-1, 2, 2)
+    self.start, self.end = ends[:, 0], ends[:, 1]
+
+  def trigger(self, detections: Detections) -> tuple[ndarray, ndarray]:
+    n = len(self.lines), len(detections)
+    crossed_in, crossed_out = np.zeros(n, bool), np.zeros(n, bool)
+    tracker_id = detections.tracker_id
+    if tracker_id is None or 0 in n:
+      return crossed_in, crossed_out
+
+    x1, y1, x2, y2 = detections.xyxy.astype(float).T
+    corners = np.stack([[x1, y1], [x1, y2], [x2, y1], [x2, y2]], axis=-1)  # (2, n, 4)
+    d = (self.end - self.start)[:, :, np.newaxis, np.newaxis]
+    rel = corners - self.start[:, :, np.newaxis, np.newaxis]  # (lines, 2, n, 4)
+    inside = d[:, 0] * rel[:, 1] - d[:, 1] * rel[:, 0] < 0  # (lines, n, 4)
+    agree = inside.all(axis=2) | ~inside.any(axis=2)
+    side = inside[:, :, 0].astype(np.int8)
+
+    # per-track last side lives in columns ordered by tracker id, -1 until first seen
+    ids = np.union1d(self.ids, tracker_id)
+    if len(ids) != len(self.ids):
+      state = np.full((len(self.lines), len(ids)), -1, np.int8)
+      state[:, np.searchsorted(ids, self.ids)] = self.state
+      self.ids, self.state = ids, state
+    col = np.searchsorted(self.ids, tracker_id)
+    last = self.state[:, col]
+    changed = agree & (last != -1) & (last != side)
+    self.state[:, col] = np.where(agree, side, last)
+
+    crossed_in = changed & (side == 1)
+    crossed_out = changed & (side == 0)
+    for line, i, o in zip(self.lines, crossed_in.sum(1).tolist(), crossed_out.sum(1).tolist()):
+      line.in_count += i
+      line.out_count += o
+    return crossed_in, crossed_out
+
+
+@define
+class Zone:
+  # what PolygonZoneAnnotator reads off a PolygonZone, membership is left to ZoneSet
+  polygon: ndarray
+  current_count: int = 0
+
+
+class ZoneSet:
+  # one label image for all zones with bit i set where zone i covers the pixel, same
+  # (w + 1, h + 1) raster and anchor rule as PolygonZone, one gather tests every zone
+  def __init__(
+    self,
+    polygons: list[ndarray],
+    reso: tuple[int, int],
+    position: Position = Position.BOTTOM_CENTER,
+  ):
+    self.reso = reso
+    self.position = position
+    self.size = len(polygons)
+    self.labels = self.masks = None
+    if not polygons:
+      return
+    w, h = reso
+    if self.size <= 64:
+      # uint8 up to 8 zones, then uint16, uint32, uint64
+      dtype = np.min_scalar_type((1 << self.size) - 1)
+      self.bits = np.ones(self.size, dtype) << np.arange(self.size, dtype=dtype)
+      self.labels = np.zeros((h + 1, w + 1), dtype)
+    else:
+      # past the widest label every zone keeps a mask of its own, as PolygonZone does
+      self.masks = np.zeros((self.size, h + 1, w + 1), bool)
+    for i, p in enumerate(polygons):
+      # filled within the polygon's bounding box only
+      x0, y0 = np.clip(p.min(axis=0), 0, (w + 1, h + 1))
+      x1, y1 = np.clip(p.max(axis=0) + 1, 0, (w + 1, h + 1))
+      if x1 <= x0 or y1 <= y0:
+        continue
+      roi = np.zeros((y1 - y0, x1 - x0), np.uint8)
+      cv2.fillPoly(roi, [(p - (x0, y0)).astype(np.int32)], 1)
+      if self.masks is None:
+        self.labels[y0:y1, x0:x1] |= roi.astype(dtype) * self.bits[i]
+      else:
+        self.masks[i, y0:y1, x0:x1] = roi
+
+  def trigger(self, detections: Detections) -> ndarray:
+    if not self.size:
+      return np.zeros((0, len(detections)), bool)
+    xyxy = clip_boxes(detections.xyxy, self.reso)
+    anchors = np.ceil(Detections(xyxy=xyxy).get_anchors_coordinates(self.position)).astype(int)
+    if self.masks is not None:
+      return self.masks[:, anchors[:, 1], anchors[:, 0]]
+    labels = self.labels[anchors[:, 1], anchors[:, 0]]
+    return (labels & self.bits[:, np.newaxis]) != 0
+
+
 class LineAndZoneAnnotator(BaseAnnotator):
+  # resolutions whose scaled geometry and label image are kept, least recently used go first
+  max_scaled = 4
+
   def __init__(
     self,
     draw: Draw = Draw(),
@@ -214,6 +448,7 @@ class LineAndZoneAnnotator(BaseAnnotator):
       )
       for i in self.draw.lines
     ]
+    self.lineset = LineSet(self.ls)
     self.line = LineZoneAnnotator(
       thickness=thickness,
       text_thickness=text_thickness,
@@ -222,14 +457,11 @@ class LineAndZoneAnnotator(BaseAnnotator):
       text_offset=text_offset,
       text_padding=text_padding,
     )
-    self.zs: list[PolygonZone] = [
-      PolygonZone(
-        polygon=np.array(p, dtype=np.int32),
-        frame_resolution_wh=self.reso,
-      )
-      for p in self.draw.zones
-    ]
-    self.origin_zs = self.zs
+    # scaled geometry per (w, h), the webcam frame size keeps changing during a session
+    self.scaled: OrderedDict[tuple[int, int], tuple[list[Vector], list[Zone], ZoneSet]] = (
+      OrderedDict({self.reso: self.rescale(self.reso)})
+    )
+    _, self.zs, self.zoneset = self.scaled[self.reso]
     self.zones: list[PolygonZoneAnnotator] = [
       PolygonZoneAnnotator(
         zone=z,
@@ -248,32 +480,45 @@ class LineAndZoneAnnotator(BaseAnnotator):
     scene: ndarray,
     detections: Detections,
   ) -> ndarray:
+    self.lineset.trigger(detections)
     for l in self.ls:  # noqa: E741
-      l.trigger(detections)
       self.line.annotate(frame=scene, line_counter=l)
 
-    for z, zone in zip(self.zs, self.zones):
-      z.trigger(detections)
-      zone.annotate(scene)
+    if self.zs:
+      counts = self.zoneset.trigger(detections).sum(axis=1).tolist()
+      for z, c, zone in zip(self.zs, counts, self.zones):
+        z.current_count = c
+        zone.annotate(scene)
 
     return scene
 
-  def update(self, f: ndarray):
-    scale = f.shape[0] / self.reso[1]
-    self.ls = [
-      LineZone(
+  def rescale(self, reso: tuple[int, int]) -> tuple[list[Vector], list[Zone], ZoneSet]:
+    scale = reso[1] / self.reso[1]
+    vectors = [
+      Vector(
         start=Point(i[0][0] * scale, i[0][1] * scale),
         end=Point(i[1][0] * scale, i[1][1] * scale),
       )
       for i in self.draw.lines
     ]
-    self.zs = [
-      PolygonZone(
-        polygon=(z.polygon * scale).astype(int),
-        frame_resolution_wh=(f.shape[1], f.shape[0]),
-      )
-      for z in self.origin_zs
-    ]
-    for i, z in enumerate(self.zs):
-      self.zones[i].zone = z
-      self.zones[i].center = get_polygon_center(polygon=z.polygon)
+    zs = [Zone((np.array(p) * scale).astype(np.int32)) for p in self.draw.zones]
+    return vectors, zs, ZoneSet([z.polygon for z in zs], reso)
+
+  def update(self, f: ndarray):
+    # counts and per-track sides survive, only the geometry is swapped
+    reso = f.shape[1], f.shape[0]
+    if reso in self.scaled:
+      self.scaled.move_to_end(reso)
+    else:
+      self.scaled[reso] = self.rescale(reso)
+      if len(self.scaled) > self.max_scaled:
+        self.scaled.popitem(last=False)
+    vectors, zs, self.zoneset = self.scaled[reso]
+    for l, v in zip(self.ls, vectors):  # noqa: E741
+      l.vector = v
+    self.lineset.scale(self.ls)
+    for z, old, zone in zip(zs, self.zs, self.zones):
+      z.current_count = old.current_count
+      zone.zone = z
+      zone.center = get_polygon_center(polygon=z.polygon)
+    self.zs = zs
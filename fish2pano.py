@@ -1,46 +1,102 @@
+import json
+import os
 import pickle
-from multiprocessing import Pool
+import shutil
+from hashlib import sha1
+from pathlib import Path
+from tempfile import mkdtemp
 
 import cv2
 import numpy as np
 
-
-def unit_vector(vector):
-  np.seterr(invalid='ignore')
-  norm = np.linalg.norm(vector)
-  return vector / norm
-
-
-def angle_between(v1, v2):
-  v1_u = unit_vector(v1)
-  v2_u = unit_vector(v2)
-  return np.arccos(np.clip(np.dot(v1_u, v2_u), -1.0, 1.0))
-
-
-def angle_map(points):
-  point, center, top_point, radius = points
-  point_np = np.asarray(point)
-  distance = np.linalg.norm(point_np - center)
-  length_percent = None
-  if distance <= radius:
-    angle = angle_between(top_point - center, point_np - center)
-    length_percent = angle / (2 * np.pi)
-  return point, length_percent, distance
+MESH_VERSION = 1
+
+
+class MeshCache:
+  def __init__(
+    self,
+    root: str = 'mesh_cache',
+    max_bytes: int = 2 << 30,
+    fixed_point: bool = False,
+  ):
+    self.root = Path(root)
+    self.max_bytes = max_bytes
+    self.fixed_point = fixed_point
+
+  def key(self, kind: str, **params) -> str:
+    blob = json.dumps([MESH_VERSION, kind, self.fixed_point, params], sort_keys=True)
+    return sha1(blob.encode()).hexdigest()[:20]
+
+  def load(self, key: str) -> tuple[np.ndarray, ...] | None:
+    path = self.root / key
+    if not path.is_dir():
+      return None
+    try:
+      files = sorted(path.glob('*.npy'), key=lambda p: int(p.stem))
+      maps = tuple(np.load(f, mmap_mode='r') for f in files)
+    except (OSError, ValueError):
+      return None
+    # mtime doubles as last-used time for eviction
+    os.utime(path)
+    return maps
+
+  def save(self, key: str, maps: tuple[np.ndarray, ...]):
+    self.root.mkdir(parents=True, exist_ok=True)
+    tmp = Path(mkdtemp(prefix='.tmp-', dir=self.root))
+    for i, m in enumerate(maps):
+      np.save(tmp / f'{i}.npy', m)
+    try:
+      tmp.rename(self.root / key)
+    except OSError:
+      # another process stored the same mesh first
+      shutil.rmtree(tmp, ignore_errors=True)
+    self.evict()
+
+  def get(self, key: str, build) -> tuple[np.ndarray, ...]:
+    if (maps := self.load(key)) is not None:
+      return maps
+    x, y, *rest = build()
+    if self.fixed_point:
+      x, y = cv2.convertMaps(x, y, cv2.CV_16SC2)
+    self.save(key, (x, y, *rest))
+    return self.load(key) or (x, y, *rest)
+
+  def evict(self):
+    entries = [d for d in self.root.iterdir() if d.is_dir() and not d.name.startswith('.')]
+    entries.sort(key=lambda d: d.stat().st_mtime, reverse=True)
+    total = 0
+    for d in entries:
+      total += sum(f.stat().st_size for f in d.iterdir())
+      if total > self.max_bytes:
+        shutil.rmtree(d, ignore_errors=True)
 
 
 class FisheyeWarping:
-  def __init__(self, img):
+  def __init__(self, img, cache: MeshCache | None = None):
     self.img = img
+    self.cache = cache
 
     self.dewarp_map_x, self.dewarp_map_y = None, None
     self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask = None, None, None
     self.pano_shape = None
-
-  def build_dewarp_mesh(self):
-    self.dewarp_map_x, self.dewarp_map_y = self.build_dewarp_map(self.img)
+    self.fused_maps = {}
+    self.rewarp_buffer = None
+
+  def build_dewarp_mesh(self, chunk_rows: int | None = None):
+    if self.cache is None:
+      self.dewarp_map_x, self.dewarp_map_y = self.build_dewarp_map(self.img, chunk_rows)
+    else:
+      key = self.cache.key(
+        'dewarp',
+        shape=self.img.shape[:2],
+        params=self.get_fisheye_img_data(self.img),
+      )
+      self.dewarp_map_x, self.dewarp_map_y = self.cache.get(
+        key, lambda: self.build_dewarp_map(self.img, chunk_rows)
+      )
     print(f'Dewarp Map X shape -> {self.dewarp_map_x.shape}')
     print(f'Dewarp Map Y shape -> {self.dewarp_map_y.shape}')
-    h, w = self.dewarp_map_x.shape
+    h, w = self.dewarp_map_x.shape[:2]
     self.pano_shape = (w, h)
     return self.pano_shape, self.dewarp_map_x, self.dewarp_map_y
 
@@ -53,7 +109,17 @@ class FisheyeWarping:
     return self.dewarp(self.img, flip=True)
 
   def build_rewarp_mesh(self):
-    self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask = self.build_rewarp_map()
+    if self.cache is None:
+      self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask = self.build_rewarp_map()
+    else:
+      key = self.cache.key(
+        'rewarp',
+        shape=self.img.shape[:2],
+        pano_w=self.get_fisheye_img_data(self.img)[0],
+      )
+      self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask = self.cache.get(
+        key, self.build_rewarp_map
+      )
     print(f'Rewarp Map X shape -> {self.rewarp_map_x.shape}')
     print(f'Rewarp Map Y shape -> {self.rewarp_map_y.shape}')
     print(f'Rewarp Map MASK shape -> {self.rewarp_mask.shape}')
@@ -64,14 +130,16 @@ class FisheyeWarping:
       self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask = pickle.load(f)
     return self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask
 
-  def run_rewarp(self):
+  def run_rewarp(self, fused=False):
     dewarp_result = self.dewarp(self.img, flip=False)
-    return self.rewarp(dewarp_result, flip=True)
+    return self.rewarp(dewarp_result, flip=True, fused=fused)
 
-  def run_rewarp_with_mesh(self, pano_img):
+  def run_rewarp_with_mesh(self, pano_img, fused=False):
     warning = 'Rewarp needs the shape of pano generated from `run_dewarp`. Please run it first.'
     assert self.pano_shape is not None, warning
     pano_img = cv2.resize(pano_img, self.pano_shape)
+    if fused:
+      return self.rewarp(pano_img, flip=True, fused=True, pre_rotate=True)
     pano_img = self.wrap(pano_img, rotate_angle=180, scale=1)
     return self.rewarp(pano_img, flip=True)
 
@@ -92,29 +160,21 @@ class FisheyeWarping:
     h_d = r2 - r1
     return w_d, h_d, r1, r2, c_x, c_y
 
-  def dewarp_map_job(self, point):
-    y, x, img_details = point
-    w_d, h_d, r1, r2, c_x, c_y = img_details
-    r = (float(y) / float(h_d)) * (r2 - r1) + r1
-    theta = (float(x) / float(w_d)) * 2.0 * np.pi
-    x_s = int(c_x + r * np.sin(theta))
-    y_s = int(c_y + r * np.cos(theta))
-    return (y, x), x_s, y_s
-
-  def build_dewarp_map(self, img):
-    img_details = self.get_fisheye_img_data(img)
-    w_d, h_d, _, _, _, _ = img_details
+  def build_dewarp_map(self, img, chunk_rows: int | None = None):
+    w_d, h_d, r1, r2, c_x, c_y = self.get_fisheye_img_data(img)
     mapx = np.zeros((h_d, w_d), np.float32)
     mapy = np.zeros((h_d, w_d), np.float32)
 
-    jobList = []
-    for y in range(int(h_d - 1)):
-      jobList.extend((y, x, img_details) for x in range(int(w_d - 1)))
-    with Pool() as p:
-      results = p.map(self.dewarp_map_job, jobList)
-    for point, x_s, y_s in results:
-      mapx.itemset(point, x_s)
-      mapy.itemset(point, y_s)
+    # the last row and column are left at zero, as in the per-pixel version
+    rows, cols = h_d - 1, w_d - 1
+    theta = np.arange(cols) / w_d * 2.0 * np.pi
+    sin, cos = np.sin(theta), np.cos(theta)
+    step = chunk_rows or max(rows, 1)
+    for top in range(0, rows, step):
+      bottom = min(top + step, rows)
+      r = (np.arange(top, bottom) / h_d * (r2 - r1) + r1)[:, np.newaxis]
+      mapx[top:bottom, :cols] = np.trunc(c_x + r * sin)
+      mapy[top:bottom, :cols] = np.trunc(c_y + r * cos)
 
     return mapx, mapy
 
@@ -137,31 +197,26 @@ class FisheyeWarping:
     return img
 
   def build_rewarp_map(self):
-    width, height, _ = self.img.shape
-    xmap = np.zeros((width, height), dtype=np.float32)
-    ymap = np.zeros((width, height), dtype=np.float32)
-    mask = np.zeros((width, height), dtype=np.uint8)
-    center = np.asarray([int(width / 2), int(height / 2)])
-    top_point = np.asarray([int(width / 2), 0])
-    radius = width / 2
-    jobs = []
-    for y, channel in enumerate(self.img):
-      for x, _ in enumerate(channel):
-        points = ((x, y), center, top_point, radius)
-        jobs.append(points)
-    print('Start multi pixel mapping for rewarpping')
-    with Pool() as p:
-      results = p.map(angle_map, jobs)
-    dewarp_result = self.dewarp(self.img, flip=False)
-    for result in results:
-      (x, y), length_percentage, distance = result
-      if length_percentage is not None:
-        point = (y, x)
-        length = length_percentage * dewarp_result.shape[1]
-        xmap.itemset(point, length)
-        ymap.itemset(point, distance)
-        mask.itemset(point, 255)
-
+    rows, cols = self.img.shape[:2]
+    # (x, y) points are measured against a (row, col) center, as the mesh always was
+    c_x, c_y = int(rows / 2), int(cols / 2)
+    radius = rows / 2
+    pano_w = self.get_fisheye_img_data(self.img)[0]
+
+    dx = np.arange(cols, dtype=np.float64)[np.newaxis] - c_x
+    dy = np.arange(rows, dtype=np.float64)[:, np.newaxis] - c_y
+    distance = np.sqrt(dx * dx + dy * dy)
+    inside = distance <= radius
+
+    top = np.array([0, -c_y], dtype=np.float64)
+    top_u = top / np.linalg.norm(top)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      cos = top_u[0] * (dx / distance) + top_u[1] * (dy / distance)
+    angle = np.arccos(np.clip(cos, -1.0, 1.0))
+
+    xmap = np.where(inside, angle / (2 * np.pi) * pano_w, 0).astype(np.float32)
+    ymap = np.where(inside, distance, 0).astype(np.float32)
+    mask = np.where(inside, 255, 0).astype(np.uint8)
     return xmap, ymap, mask
 
   def remap(self, img, x, y):
@@ -174,11 +229,49 @@ class FisheyeWarping:
     right_output = self.remap(cv2.flip(pano_img, 1), x, y)
     return left_output, right_output
 
-  def rewarp(self, pano_img, flip=False):
+  def build_fused_rewarp_map(self, pano_w, pano_h, flip=False, pre_rotate=False):
+    x, y, mask = self.rewarp_map_x, self.rewarp_map_y, self.rewarp_mask > 0
+    if x.ndim == 3:
+      x, y = cv2.convertMaps(x, y, cv2.CV_32FC1)
+    rows, cols = x.shape
+
+    # right half samples the horizontally flipped pano
+    vertical_center = int(rows / 2) + 1
+    x = np.where(np.arange(cols) >= vertical_center, pano_w - 1 - x, x)
+    if pre_rotate:
+      # `wrap(pano, 180)` reads (w - c, h - r) and drops row 0 and column 0 of the pano,
+      # so the map samples `pano[1:, 1:]`, where that is (w - 1 - c, h - 1 - r)
+      x, y = pano_w - 1 - x, pano_h - 1 - y
+    # masked-out pixels sample outside the pano, i.e. the black border
+    x = np.where(mask, x, -1).astype(np.float32)
+    y = np.where(mask, y, -1).astype(np.float32)
+
+    if flip:
+      # `wrap(img, 180)` maps (c, r) to (cols - c, rows - r), leaving row 0 and column 0 black
+      fx, fy = np.full_like(x, -1), np.full_like(y, -1)
+      fx[1:, 1:] = x[:0:-1, :0:-1]
+      fy[1:, 1:] = y[:0:-1, :0:-1]
+      x, y = fx, fy
+
+    return cv2.convertMaps(x, y, cv2.CV_16SC2)
+
+  def rewarp(self, pano_img, flip=False, fused=False, pre_rotate=False):
     warning = 'Rewarp mesh have not been created! Please run `build_rewarp_mesh` first.'
     assert self.rewarp_map_x is not None, warning
     assert self.rewarp_map_y is not None, warning
     assert self.rewarp_mask is not None, warning
+    if fused:
+      h, w = pano_img.shape[:2]
+      key = (w, h, flip, pre_rotate)
+      if key not in self.fused_maps:
+        self.fused_maps[key] = self.build_fused_rewarp_map(w, h, flip, pre_rotate)
+      map1, map2 = self.fused_maps[key]
+      if pre_rotate:
+        pano_img = pano_img[1:, 1:]
+      # the buffer is reused on the next call, copy the result to keep it
+      self.rewarp_buffer = cv2.remap(pano_img, map1, map2, cv2.INTER_LINEAR, dst=self.rewarp_buffer)
+      return self.rewarp_buffer
+
     left_output, right_output = self.half_rewarp_map(pano_img, self.rewarp_map_x, self.rewarp_map_y)
 
     re_render_canvas = left_output
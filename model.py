@@ -1,42 +1,349 @@
+import os
+from ast import literal_eval
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
 from glob import glob
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Lock
+from time import perf_counter
 from typing import Generator
 
 import numpy as np
-import streamlit as st
-import yolov5
 from attrs import define
 from numpy import ndarray
 from PIL import Image
-from streamlit import sidebar as sb
 from supervision import BoxAnnotator, Detections
 from ultralytics import NAS, RTDETR, SAM, YOLO
 from ultralytics.engine.results import Boxes, Results
+from ultralytics.utils import yaml_load
 from vidgear.gears import VideoGear
 
-from utils import cvt, filter_by_vals
+from utils import Profiler, Timed, batched, cvt, filter_by_vals
 
-coconames = YOLO().names
+# same table as `YOLO().names`, without loading a checkpoint at import
+coconames = {
+  0: 'person',
+  1: 'bicycle',
+  2: 'car',
+  3: 'motorcycle',
+  4: 'airplane',
+  5: 'bus',
+  6: 'train',
+  7: 'truck',
+  8: 'boat',
+  9: 'traffic light',
+  10: 'fire hydrant',
+  11: 'stop sign',
+  12: 'parking meter',
+  13: 'bench',
+  14: 'bird',
+  15: 'cat',
+  16: 'dog',
+  17: 'horse',
+  18: 'sheep',
+  19: 'cow',
+  20: 'elephant',
+  21: 'bear',
+  22: 'zebra',
+  23: 'giraffe',
+  24: 'backpack',
+  25: 'umbrella',
+  26: 'handbag',
+  27: 'tie',
+  28: 'suitcase',
+  29: 'frisbee',
+  30: 'skis',
+  31: 'snowboard',
+  32: 'sports ball',
+  33: 'kite',
+  34: 'baseball bat',
+  35: 'baseball glove',
+  36: 'skateboard',
+  37: 'surfboard',
+  38: 'tennis racket',
+  39: 'bottle',
+  40: 'wine glass',
+  41: 'cup',
+  42: 'fork',
+  43: 'knife',
+  44: 'spoon',
+  45: 'bowl',
+  46: 'banana',
+  47: 'apple',
+  48: 'sandwich',
+  49: 'orange',
+  50: 'broccoli',
+  51: 'carrot',
+  52: 'hot dog',
+  53: 'pizza',
+  54: 'donut',
+  55: 'cake',
+  56: 'chair',
+  57: 'couch',
+  58: 'potted plant',
+  59: 'bed',
+  60: 'dining table',
+  61: 'toilet',
+  62: 'tv',
+  63: 'laptop',
+  64: 'mouse',
+  65: 'remote',
+  66: 'keyboard',
+  67: 'cell phone',
+  68: 'microwave',
+  69: 'oven',
+  70: 'toaster',
+  71: 'sink',
+  72: 'refrigerator',
+  73: 'book',
+  74: 'clock',
+  75: 'vase',
+  76: 'scissors',
+  77: 'teddy bear',
+  78: 'hair drier',
+  79: 'toothbrush',
+}
 
 
 class LegacyYoloV5:
   def __init__(
     self,
-    source: str | int,
+    model,
     classes: list[int],
     conf: float,
     iou: float,
   ):
-    self.model = yolov5.load(source)
-    self.model.classes = classes
-    self.model.conf = conf
-    self.model.iou = iou
+    self.model = model
+    self.classes = classes
+    self.conf = conf
+    self.iou = iou
+
+  def __call__(self, f: ndarray | list[ndarray]) -> list[Results]:
+    # the yolov5 model may be shared, so its settings are applied per call
+    self.model.classes = self.classes
+    self.model.conf = self.conf
+    self.model.iou = self.iou
+    frames = f if isinstance(f, list) else [f]
+    results = []
+    for frame, pred in zip(frames, self.model(frames).pred):
+      res = Results(orig_img=frame, path=None, names=self.model.names)
+      res.boxes = Boxes(pred, frame.shape)
+      results.append(res)
+    return results
+
+
+class Fallback:
+  __slots__ = ('_img', 'res')
+
+  def __init__(self, res: Results | None = None, snapshot: bool = False):
+    # the annotators draw on the frame in place before `img` is read, consumers of `img`
+    # ask for a clean copy to plot on
+    if res is not None and snapshot:
+      res.orig_img = res.orig_img.copy()
+    self.res = res
+    self._img = None
+
+  @property
+  def img(self) -> ndarray:
+    # ultralytics plotting only runs for consumers that look at it
+    if self._img is None:
+      if self.res is None:
+        self._img = np.zeros((1, 1, 3))
+      else:
+        self._img = cvt(self.res.plot(line_width=1, kpt_radius=1))
+        self.res = None
+    return self._img
+
+
+EXPORTS = {
+  'onnxruntime': ('onnx', '.onnx'),
+  'openvino': ('openvino', '_openvino_model'),
+}
+EXPORTABLE = ('v8', 'v5u', 'v3')
+
+
+def export_net(path: str, backend: str, imgsz: int = 640, opset: int = 12) -> str:
+  fmt, suffix = EXPORTS[backend]
+  weights = Path(path)
+  target = weights.with_name(f'{weights.stem}-{imgsz}-op{opset}{suffix}')
+  if target.exists():
+    return str(target)
+
+  # ultralytics names the export after the weights, so each export runs on a link in its own
+  # directory, concurrent workers and a user's `<stem>.onnx` never see a half written file
+  ckpt = Path(YOLO(path).ckpt_path).resolve()
+  with TemporaryDirectory(dir=weights.parent, prefix=f'.{weights.stem}-') as tmp:
+    link = Path(tmp) / ckpt.name
+    link.symlink_to(ckpt)
+    exported = YOLO(str(link)).export(format=fmt, imgsz=imgsz, opset=opset)
+    try:
+      os.replace(exported, target)
+    except OSError:
+      # another worker published its OpenVINO directory first
+      if not target.exists():
+        raise
+  return str(target)
 
-  def __call__(self, f: ndarray) -> list[Results]:
-    res = Results(orig_img=f, path=None, names=self.model.names)
-    pred = self.model(f).pred[0]
-    res.boxes = Boxes(pred, f.shape)
-    return [res]
+
+def export_names(exported: str) -> dict[int, str] | None:
+  # exports keep the class names of their weights in their metadata, ultralytics only reads
+  # them when the first frame goes through
+  path = Path(exported)
+  if path.is_dir():
+    meta = path / 'metadata.yaml'
+    names = yaml_load(meta).get('names') if meta.exists() else None
+  else:
+    from onnxruntime import InferenceSession
+
+    session = InferenceSession(str(path), providers=['CPUExecutionProvider'])
+    names = session.get_modelmeta().custom_metadata_map.get('names')
+  if isinstance(names, str):
+    names = literal_eval(names)
+  return {int(k): v for k, v in names.items()} if names else None
+
+
+def load_net(
+  path: str,
+  ver: str,
+  task: str = 'detect',
+  backend: str = 'torch',
+  imgsz: int = 640,
+):
+  if backend != 'torch':
+    if ver not in EXPORTABLE:
+      raise ValueError(f'{backend} backend only supports YOLO {", ".join(EXPORTABLE)} weights')
+    return YOLO(export_net(path, backend, imgsz), task=task)
+  match ver:
+    case 'v5':
+      import yolov5
+
+      return yolov5.load(path)
+    case 'sam':
+      return SAM(path)
+    case 'rtdetr':
+      return RTDETR(path)
+    case 'NAS':
+      return NAS(path)
+    case _:
+      return YOLO(path)
+
+
+def nbytes(net) -> int:
+  try:
+    return sum(p.numel() * p.element_size() for p in getattr(net, 'model', net).parameters())
+  except (AttributeError, TypeError):
+    return 0
+
+
+@define
+class Entry:
+  net: object
+  lock: Lock
+  nbytes: int
+
+
+class Registry:
+  def __init__(
+    self,
+    maxsize: int = 4,
+    max_bytes: int | None = None,
+    warmup: bool = False,
+  ):
+    self.maxsize = maxsize
+    self.max_bytes = max_bytes
+    self.warmup = warmup
+    self.entries: OrderedDict[tuple, Entry] = OrderedDict()
+    # checkpoint path a net resolved to -> the key it was loaded under
+    self.aliases: dict[tuple, tuple] = {}
+    self.loading: dict[tuple, Lock] = {}
+    self.lock = Lock()
+
+  @staticmethod
+  def key(path: str, ver: str, task: str, backend: str, imgsz: int) -> tuple:
+    # trackers live per Model, see `Model.session`, and torch weights load the same for any task
+    if backend == 'torch':
+      return path, ver, backend
+    return path, ver, task, backend, imgsz
+
+  def get(
+    self,
+    path: str,
+    ver: str = 'v8',
+    task: str = 'detect',
+    backend: str = 'torch',
+    imgsz: int = 640,
+  ) -> Entry:
+    key = self.key(path, ver, task, backend, imgsz)
+    with self.lock:
+      key = self.aliases.get(key, key)
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        return self.entries[key]
+      loading = self.loading.setdefault(key, Lock())
+
+    # a slow load only holds up callers asking for the same net
+    with loading:
+      with self.lock:
+        if key in self.entries:
+          self.entries.move_to_end(key)
+          return self.entries[key]
+
+      net = load_net(path, ver, task, backend, imgsz)
+      if self.warmup:
+        self.warm(net, ver)
+      entry = Entry(net, Lock(), nbytes(net))
+      with self.lock:
+        self.entries[key] = entry
+        self.loading.pop(key, None)
+        ckpt = getattr(net, 'ckpt_path', None)
+        if ckpt and ckpt != path:
+          self.aliases[self.key(ckpt, ver, task, backend, imgsz)] = key
+        self.evict()
+      return entry
+
+  def put(
+    self,
+    net,
+    path: str,
+    ver: str = 'v8',
+    task: str = 'detect',
+    backend: str = 'torch',
+    imgsz: int = 640,
+  ) -> Entry:
+    # serves an already built net under the key `get` would load it by, e.g. a stub detector
+    key = self.key(path, ver, task, backend, imgsz)
+    with self.lock:
+      entry = Entry(net, Lock(), nbytes(net))
+      self.entries[key] = entry
+      self.evict()
+      return entry
+
+  def warm(self, net, ver: str):
+    dummy = np.zeros((640, 640, 3), np.uint8)
+    match ver:
+      case 'v5':
+        net(dummy)
+      case 'sam':
+        pass
+      case _:
+        net.predict(dummy, verbose=False)
+
+  def evict(self):
+    while len(self.entries) > 1 and (
+      len(self.entries) > self.maxsize
+      or (self.max_bytes and sum(e.nbytes for e in self.entries.values()) > self.max_bytes)
+    ):
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.aliases.clear()
+
+
+registry = Registry()
 
 
 @define
@@ -48,93 +355,264 @@ class ModelInfo:
   conf: float = 0.25
   iou: float = 0.5
   tracker: str | None = None
+  stride: int = 1
+  backend: str = 'torch'
+  imgsz: int = 640
+
+
+class Stride:
+  __slots__ = ('count', 'every', 'fallback', 'last', 'since', 'velocity')
+
+  def __init__(self, every: int = 1):
+    self.every = every
+    self.count = 0
+    self.last: Detections | None = None
+    self.velocity: ndarray | None = None
+    self.since = 0
+    # skipped frames show the last plotted one, pose and classify use it as the main view
+    self.fallback = Fallback()
+
+  def skip(self) -> bool:
+    skip = self.every > 1 and self.count % self.every != 0
+    self.count += 1
+    return skip
+
+  def update(self, det: Detections, fallback: Fallback):
+    if self.every == 1:
+      return
+    self.fallback = fallback
+    velocity = np.zeros((len(det), 4))
+    last = self.last
+    if last is not None and det.tracker_id is not None and last.tracker_id is not None:
+      _, i, j = np.intersect1d(det.tracker_id, last.tracker_id, return_indices=True)
+      velocity[i] = (det.xyxy[i] - last.xyxy[j]) / (self.since + 1)
+    self.last, self.velocity, self.since = det, velocity, 0
+
+  def extrapolate(self) -> Detections:
+    self.since += 1
+    det = copy(self.last)
+    det.xyxy = self.last.xyxy + self.velocity * self.since
+    # masks cannot follow the boxes cheaply, mask annotators skip these frames
+    det.mask = None
+    return det
 
 
 class Model:
   __slots__ = (
     'classes',
     'conf',
+    'fallback',
     'info',
     'iou',
     'legacy',
+    'lock',
     'model',
     'names',
+    'net',
     'options',
     'preprocessors',
+    'profiler',
+    'stride',
     'task',
     'tracker',
+    'tracks',
   )
 
   def __init__(
     self,
     info: ModelInfo = ModelInfo(),
   ):
+    ver = info.ver
+    entry = registry.get(info.path, ver, info.task, info.backend, info.imgsz)
+    net = entry.net
+
+    legacy = ver == 'v5'
+    match ver:
+      case 'v5':
+        names = net.names
+      case 'sam':
+        names = []
+      case 'rtdetr':
+        names = coconames
+      case 'NAS':
+        names = net.model.names
+      case _:
+        names = net.names if info.backend == 'torch' else export_names(net.model)
+
+    names = names or coconames
+    self.names = names
+    self.net = net
+    self.legacy = legacy
+    self.lock = entry.lock
+    self.tracks = None
+    self.preprocessors: list[callable] = []
+    self.profiler: Profiler | None = None
+    # set by callers that read `Fallback.img` after annotating the frame, e.g. the web UI
+    self.fallback = False
+    self.configure(info)
+
+  def configure(self, info: ModelInfo):
     classes = info.classes
-    task = info.task
     conf = info.conf
     iou = info.iou
     tracker = info.tracker
-    path = info.path
-    ver = info.ver
 
-    options = {}
-    legacy = ver == 'v5'
     options = dict(
       classes=classes,
       conf=conf,
       iou=iou,
       retina_masks=True,
     )
-    if legacy:
-      model = LegacyYoloV5(path, classes, conf, iou)
-      names = model.model.names
+    if self.legacy:
+      model = LegacyYoloV5(self.net, classes, conf, iou)
       options = {}
     else:
       if tracker:
         options.update(tracker=f'{tracker}.yaml', persist=True)
-      match ver:
-        case 'sam':
-          model = SAM(path)
-          names = []
-        case 'rtdetr':
-          model = RTDETR(path)
-          names = coconames
-        case 'NAS':
-          model = NAS(path)
-          names = model.model.names
-        case _:
-          model = YOLO(path)
-          names = model.names
-      model = model.predict if tracker is None else model.track
+      if info.backend != 'torch':
+        options.update(imgsz=info.imgsz)
+      model = self.net.predict if tracker is None else self.net.track
 
-    names = names or coconames
-    self.names = names
-    self.task = task
+    self.task = info.task
     self.tracker = tracker
     self.info = info
     self.options = options
     self.model = model
-    self.legacy = legacy
-    self.preprocessors: list[callable] = []
+    self.stride = Stride(info.stride)
 
-  def __call__(self, source: str | int) -> Generator:
+  def fork(self, info: ModelInfo | None = None):
+    info = self.info if info is None else info
+    net = (info.path, info.ver, info.backend, info.imgsz)
+    own = (self.info.path, self.info.ver, self.info.backend, self.info.imgsz)
+    if net != own:
+      raise ValueError(f'{net} cannot share the weights of {own}')
+    other = copy(self)
+    other.preprocessors = []
+    other.tracks = None
+    other.profiler = None
+    other.configure(info)
+    return other
+
+  def profile(self, profiler: Profiler):
+    # swaps in timed callables, with profiling off only `convert` pays a None check
+    self.profiler = profiler
+    self.model = profiler.wrap('infer', self.model)
+    self.preprocessors = [
+      Timed(p, profiler, f'preprocess/{type(p).__name__}') for p in self.preprocessors
+    ]
+
+  @contextmanager
+  def session(self):
+    # one predictor serves every fork, each fork brings its own tracker state
+    with self.lock:
+      predictor = getattr(self.net, 'predictor', None)
+      tracked = predictor is not None and hasattr(predictor, 'trackers')
+      if tracked:
+        # only registered once some fork has tracked, so detection-only use never imports it
+        from ultralytics.trackers.track import on_predict_postprocess_end, on_predict_start
+
+      if self.tracker and tracked:
+        if self.tracks is None:
+          # the predictor args still name the tracker of whichever fork ran last
+          predictor.args.tracker = self.options['tracker']
+          on_predict_start(predictor)
+        else:
+          predictor.trackers = self.tracks
+
+      hidden = {}
+      if not self.tracker and tracked:
+        # `net.track` left its callbacks on the shared net, an untracked fork runs without them
+        # and without the trackers, so neither its boxes nor the tracked forks' state mix
+        callbacks = self.net.callbacks
+        ours = (on_predict_start, on_predict_postprocess_end)
+        for event in ('on_predict_start', 'on_predict_postprocess_end'):
+          hidden[event] = callbacks[event]
+          callbacks[event] = [c for c in callbacks[event] if getattr(c, 'func', c) not in ours]
+        trackers = predictor.trackers
+        del predictor.trackers
+
+      try:
+        yield
+      finally:
+        if hidden:
+          callbacks.update(hidden)
+          predictor.trackers = trackers
+      if self.tracker:
+        self.tracks = getattr(getattr(self.net, 'predictor', None), 'trackers', None)
+
+  def __call__(self, source: str | int, batch: int = 1) -> Generator:
     stream = VideoGear(source=source).start()
-    return self.gen(stream)
+    return self.gen(stream, batch)
+
+  def gen(self, stream: VideoGear, batch: int = 1) -> Generator:
+    if batch == 1:
+      while (f := stream.read()) is not None:
+        yield self.infer(self.preprocess(f))
+    else:
+      for frames in batched(iter(stream.read, None), batch):
+        yield from self.infer_batch([self.preprocess(f) for f in frames])
+
+  def preprocess(self, f: ndarray) -> list[ndarray]:
+    frames = [f]
+    for p in self.preprocessors:
+      frames.append(p(frames[-1]))
+    return frames
 
-  def gen(self, stream: VideoGear) -> Generator:
-    while (f := stream.read()) is not None:
-      if self.preprocessors:
-        for p in self.preprocessors:
-          f = p(f)
-      yield f, self.from_frame(f)
+  def infer(self, frames: list[ndarray]) -> tuple[ndarray, tuple[Detections, Fallback]]:
+    return self.infer_batch([frames])[0]
 
-  def from_frame(self, f: ndarray) -> tuple[Detections, ndarray]:
-    res = self.model(f, **self.options)[0]
+  def infer_batch(
+    self, batch: list[list[ndarray]]
+  ) -> list[tuple[ndarray, tuple[Detections, Fallback]]]:
+    skips = [self.stride.skip() for _ in batch]
+    detect = [frames[-1] for frames, skip in zip(batch, skips) if not skip]
+    if len(detect) == 1:
+      results = iter([self.from_frame(detect[0])])
+    else:
+      results = iter(self.from_batch(detect) if detect else [])
+
+    # trailing preprocessors that can map detections back hand out their input frame
+    i = len(self.preprocessors)
+    while i and hasattr(self.preprocessors[i - 1], 'backproject'):
+      i -= 1
+    out = []
+    for frames, skip in zip(batch, skips):
+      if skip:
+        out.append((frames[i], (self.stride.extrapolate(), self.stride.fallback)))
+        continue
+      det, fallback = next(results)
+      for p in reversed(self.preprocessors[i:]):
+        det = p.backproject(det)
+      self.stride.update(det, fallback)
+      out.append((frames[i], (det, fallback)))
+    return out
+
+  def from_frame(self, f: ndarray) -> tuple[Detections, Fallback]:
+    with self.session():
+      res = self.model(f, **self.options)[0]
+    return self.convert(res)
+
+  def from_batch(self, frames: list[ndarray]) -> list[tuple[Detections, Fallback]]:
+    if self.tracker:
+      raise ValueError(
+        f'Batched inference cannot run the {self.tracker} tracker: '
+        'tracker state would be split across frames of the batch, use batch size 1'
+      )
+    with self.session():
+      results = self.model(frames, **self.options)
+    return [self.convert(res) for res in results]
+
+  def convert(self, res: Results) -> tuple[Detections, Fallback]:
+    if self.profiler is not None:
+      start = perf_counter()
     det = Detections.from_ultralytics(res) if res.boxes is not None else Detections.empty()
-    fallback = np.zeros((1, 1, 3)) if self.legacy else cvt(res.plot(line_width=1, kpt_radius=1))
-    return det, fallback
+    if self.profiler is not None:
+      self.profiler.record('convert', perf_counter() - start)
+    return det, Fallback(None if self.legacy else res, self.fallback)
 
   def predict_image(self, file: str | bytes | Path):
+    import streamlit as st
+
     f = np.array(Image.open(file))
     if self.legacy:
       det = Detections.from_ultralytics(self.model(f)[0])
@@ -144,13 +622,17 @@ class Model:
         labels=[f'{conf:0.2f} {self.names[cls]}' for _, _, conf, cls, _ in det],
       )
     else:
-      f = cvt(self.from_frame(f)[1])
+      f = cvt(self.from_frame(f)[1].img)
     st.image(f)
 
   @classmethod
   def ui(cls, track: bool = True):  # sourcery skip: low-code-quality
+    import streamlit as st
+    from streamlit import sidebar as sb
+
     ex = sb.expander('Model', expanded=True)
     tracker = None
+    backend, imgsz = 'torch', 640
 
     match ex.radio(
       ' ',
@@ -207,35 +689,44 @@ class Model:
           path = f'yolo{v}{s}{t}{u}.pt'
 
         if legacy:
-          model = yolov5.load(path)
+          model = registry.get(path, ver).net
         else:
           if is_nas:
             try:
-              model = NAS(path)
+              model = registry.get(path, ver).net
             except FileNotFoundError:
               st.warning(
                 'You might want to go to https://docs.ultralytics.com/models to download the weights first.'
               )
           else:
-            model = YOLO(path)
+            model = registry.get(path, ver, task.lower()).net
             task = model.overrides['task']
             path = model.ckpt_path
 
           if custom:
             c3.subheader(f'{task.capitalize()}')
 
+          if ver in EXPORTABLE:
+            backend = ex.selectbox(
+              'Backend',
+              ('torch', *EXPORTS),
+              help='Exported graphs are cached next to the weights',
+            )
+            if backend != 'torch':
+              imgsz = ex.number_input('Image size', 32, 1920, 640, 32)
+
       case 'RT-DETR':
         ver = 'rtdetr'
         task = 'detect'
         size = ex.selectbox('Size', ('l', 'x'))
         path = f'{ver}-{size}.pt'
-        model = RTDETR(path)
+        model = registry.get(path, ver, task).net
       case 'SAM':
         ver = 'sam'
         task = 'segment'
         size = ex.selectbox('Size', ('mobile_sam', 'sam_b', 'sam_l'))
         path = f'{size}.pt'
-        model = SAM(path)
+        model = registry.get(path, ver, task).net
 
     if ver != 'sam':
       if track:
@@ -252,12 +743,20 @@ class Model:
       )
       conf = ex.slider('Threshold', max_value=1.0, value=0.25)
       iou = ex.slider('IoU', max_value=1.0, value=0.5)
+      stride = ex.number_input(
+        'Detect every N frames',
+        1,
+        30,
+        1,
+        help='Boxes in between follow the tracked velocity',
+      )
     else:
       classes = []
       conf = 0.25
       iou = 0.5
+      stride = 1
 
-    return cls(
+    model = cls(
       ModelInfo(
         path=path,
         classes=classes,
@@ -266,5 +765,10 @@ class Model:
         conf=conf,
         iou=iou,
         tracker=tracker,
+        stride=stride,
+        backend=backend,
+        imgsz=imgsz,
       )
     )
+    model.fallback = True
+    return model
@@ -1,28 +1,236 @@
 #!/usr/bin/env python3
-from cv2 import destroyAllWindows, imshow, waitKey
-from typer import run
+import json
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import suppress
+from multiprocessing import get_context
+from pathlib import Path
+from queue import Empty, Full, Queue
+from subprocess import DEVNULL, run as sh
+from threading import Event, Thread
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+from cv2 import (
+  CAP_PROP_FPS,
+  CAP_PROP_FRAME_COUNT,
+  CAP_PROP_POS_FRAMES,
+  VideoCapture,
+  destroyAllWindows,
+  imshow,
+  waitKey,
+)
+from typer import BadParameter, Option, run
 from vidgear.gears import WriteGear
 
-from core import Annotator
+# core pulls in torch and ultralytics, `--help` should not wait for them
+if TYPE_CHECKING:
+  from core import Annotator
 
 
-def app(source=0, config='config.json', saveto=None):
+def parse_source(source):
   if '.' not in source and int(source) in range(-1, 2):
     source = int(source)
+  return source
+
+
+def worker(an: 'Annotator', source, sink, stop: Event):
+  for f, _ in an.gen(source):
+    if stop.is_set():
+      break
+    sink(f)
+
+
+def multi(streams: list[str], saveto=None, queue: int = 4):
+  from core import Annotator
+
+  runners = []
+  model = None
+  for s in streams:
+    source, _, config = s.partition('=')
+    an = Annotator.load(config or 'config.json', model)
+    model = model or an.model
+    runners.append((parse_source(source), an))
+
+  stop = Event()
+  if saveto is None:
+    frames = [Queue(queue) for _ in runners]
+
+    def show(q):
+      def put(f):
+        # a slow display drops frames instead of stalling the stream
+        with suppress(Full):
+          q.put_nowait(f)
+
+      return put
+
+    sinks = [show(q) for q in frames]
+  else:
+    path = Path(saveto)
+    writers = [
+      WriteGear(output=str(path.with_stem(f'{path.stem}_{i}'))) for i in range(len(runners))
+    ]
+    sinks = [w.write for w in writers]
+
+  threads = [
+    Thread(target=worker, args=(an, source, sink, stop), daemon=True)
+    for (source, an), sink in zip(runners, sinks)
+  ]
+  for t in threads:
+    t.start()
+
+  if saveto is None:
+    while any(t.is_alive() for t in threads):
+      for (source, _), q in zip(runners, frames):
+        with suppress(Empty):
+          imshow(str(source), q.get_nowait())
+      if waitKey(1) & 0xFF == ord('q'):
+        break
+    stop.set()
+    destroyAllWindows()
+  for t in threads:
+    t.join()
+  if saveto is not None:
+    for w in writers:
+      w.close()
 
-  gen = Annotator.load(config).gen(source)
+
+def metered(gen, an: 'Annotator', path: str | None, every: float):
+  if path is None:
+    yield from gen
+    return
+  last = perf_counter()
+  for item in gen:
+    yield item
+    if perf_counter() - last > every:
+      an.profiler.dump(path)
+      last = perf_counter()
+  an.profiler.dump(path)
+
+
+def line_counts(an: 'Annotator') -> list[tuple[int, int]]:
+  return [(l.in_count, l.out_count) for l in an.linezone.ls] if an.linezone else []  # noqa: E741
+
+
+def segment(config: str, source: str, start: int, stop: int, warmup: int, saveto: str):
+  from core import Annotator
+
+  an = Annotator.load(config)
+  cap = VideoCapture(source)
+  first = max(start - warmup, 0)
+  cap.set(CAP_PROP_POS_FRAMES, first)
+  writer = WriteGear(output=saveto)
+
+  # warm-up frames feed the tracker, traces and line sides but are not written,
+  # crossings they trigger belong to the previous segment
+  base = line_counts(an)
+  for i in range(first, stop):
+    ok, f = cap.read()
+    if not ok:
+      break
+    if i == start:
+      base = line_counts(an)
+    f, (det, _) = an.model.infer(an.model.preprocess(f))
+    f = an(f, det)
+    if i >= start:
+      writer.write(f)
+  cap.release()
+  writer.close()
+  return [(i - bi, o - bo) for (i, o), (bi, bo) in zip(line_counts(an), base)]
+
+
+def shard(source: str, config: str, saveto: str, workers: int, warmup: float):
+  cap = VideoCapture(source)
+  total = int(cap.get(CAP_PROP_FRAME_COUNT))
+  fps = cap.get(CAP_PROP_FPS)
+  cap.release()
+
+  bounds = [total * i // workers for i in range(workers + 1)]
+  path = Path(saveto)
+  parts = [str(path.with_stem(f'{path.stem}.part{i}')) for i in range(workers)]
+  with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as ex:
+    jobs = [
+      ex.submit(segment, config, source, a, b, int(warmup * fps), part)
+      for a, b, part in zip(bounds, bounds[1:], parts)
+    ]
+    counts = [j.result() for j in jobs]
+
+  playlist = path.with_suffix('.txt')
+  playlist.write_text(''.join(f"file '{Path(p).resolve()}'\n" for p in parts))
+  sh(
+    ['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', str(playlist), '-c', 'copy', saveto],
+    check=True,
+    stdin=DEVNULL,
+    stdout=DEVNULL,
+    stderr=DEVNULL,
+  )
+  playlist.unlink()
+  for p in parts:
+    Path(p).unlink()
+
+  # overlays inside each segment count from that segment's start, the totals are merged here
+  lines = [{'in': sum(i for i, _ in c), 'out': sum(o for _, o in c)} for c in zip(*counts)]
+  path.with_suffix('.counts.json').write_text(json.dumps(lines, indent=2))
+  for n, line in enumerate(lines):
+    print(f'line {n}: {line["in"]} in, {line["out"]} out')
+
+
+def app(
+  source=0,
+  config='config.json',
+  saveto=None,
+  threaded: bool = True,
+  queue: int = 4,
+  batch: int = 1,
+  stream: list[str] = Option(
+    None,
+    help='SOURCE=CONFIG, repeat to run several streams on one shared model',
+  ),
+  workers: int = Option(1, help='Split a video file into this many segments processed in parallel'),
+  warmup: float = Option(2.0, help='Seconds replayed before each segment to warm up tracking'),
+  metrics: str = Option(None, help='Time stages and annotators, write Prometheus text here'),
+  metrics_every: float = Option(5.0, help='Seconds between metrics file updates'),
+):
+  if stream:
+    return multi(stream, saveto, queue)
+  if workers > 1:
+    if saveto is None or not Path(str(source)).is_file():
+      raise BadParameter('needs a video file as --source and --saveto', param_hint='--workers')
+    return shard(source, config, saveto, workers, warmup)
+
+  from core import Annotator
+
+  source = parse_source(source)
+  an = Annotator.load(config)
+  if metrics is not None:
+    an.profile()
 
   if saveto is None:
-    for f, _ in gen:
+    gen = an.stream(source, queue) if threaded else an.gen(source)
+    for f, _ in metered(gen, an, metrics, metrics_every):
       imshow('', f)
       if waitKey(1) & 0xFF == ord('q'):
         break
     destroyAllWindows()
   else:
+    if batch > 1 and an.model.tracker:
+      raise BadParameter(
+        f'tracker {an.model.tracker} needs frames one by one, use --batch 1', param_hint='--batch'
+      )
     writer = WriteGear(output=saveto)
-    for f, _ in gen:
-      writer.write(f)
+    start = perf_counter()
+    n = 0
+    if threaded:
+      gen = an.stream(source, queue, sink=writer.write, batch=batch)
+      for _ in metered(gen, an, metrics, metrics_every):
+        n += 1
+    else:
+      write = writer.write if an.profiler is None else an.profiler.wrap('write', writer.write)
+      for f, _ in metered(an.gen(source, batch), an, metrics, metrics_every):
+        write(f)
+        n += 1
     writer.close()
+    t = perf_counter() - start
+    print(f'{n} frames in {t:.1f}s: {n / t:.1f} fps (batch {batch}, threaded {threaded})')
 
 
 if __name__ == '__main__':
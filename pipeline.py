@@ -0,0 +1,81 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Callable, Generator, Iterable
+
+_END = object()
+
+
+class Pipeline:
+  def __init__(self, stages: list[tuple[str, Callable]], maxsize: int = 4):
+    self.stages = stages
+    self.maxsize = maxsize
+    self.queues: dict[str, Queue] = {}
+    self.stop = Event()
+    self.error: BaseException | None = None
+
+  def depths(self) -> dict[str, int]:
+    return {k: q.qsize() for k, q in self.queues.items()}
+
+  def put(self, q: Queue, item) -> bool:
+    while not self.stop.is_set():
+      try:
+        q.put(item, timeout=0.1)
+        return True
+      except Full:
+        pass
+    return False
+
+  def get(self, q: Queue):
+    while not self.stop.is_set():
+      try:
+        return q.get(timeout=0.1)
+      except Empty:
+        pass
+    return _END
+
+  def feed(self, source: Iterable, out: Queue):
+    try:
+      for item in source:
+        if not self.put(out, item):
+          return
+    except Exception as e:
+      self.error = e
+    self.put(out, _END)
+
+  def work(self, fn: Callable, inp: Queue, out: Queue):
+    while (item := self.get(inp)) is not _END:
+      try:
+        item = fn(item)
+      except Exception as e:
+        self.error = e
+        break
+      if not self.put(out, item):
+        return
+    self.put(out, _END)
+
+  def __call__(self, source: Iterable) -> Generator:
+    # one thread per stage, each stage reads the queue named after it;
+    # a single consumer per queue keeps frames in order
+    self.stop.clear()
+    self.error = None
+    self.queues = {name: Queue(self.maxsize) for name, _ in self.stages}
+    self.queues['out'] = Queue(self.maxsize)
+    qs = list(self.queues.values())
+
+    threads = [Thread(target=self.feed, args=(source, qs[0]), daemon=True)]
+    threads += [
+      Thread(target=self.work, args=(fn, qs[i], qs[i + 1]), daemon=True)
+      for i, (_, fn) in enumerate(self.stages)
+    ]
+    for t in threads:
+      t.start()
+
+    try:
+      while (item := self.get(qs[-1])) is not _END:
+        yield item
+    finally:
+      self.stop.set()
+      for t in threads:
+        t.join()
+    if self.error is not None:
+      raise self.error
@@ -1,28 +1,38 @@
 import os
-from copy import deepcopy
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from copy import copy, deepcopy
+from functools import cache, lru_cache, wraps
 from inspect import signature
+from itertools import islice
+from pathlib import Path
 from subprocess import check_output
-from time import gmtime, strftime
+from threading import Lock
+from time import gmtime, perf_counter, strftime
+from typing import TYPE_CHECKING, Generator, Iterable
 
 import cv2
 import numpy as np
-import streamlit as st
 from attrs import asdict, define
-from cv2 import getOptimalNewCameraMatrix, undistort
+from cv2 import getOptimalNewCameraMatrix, initUndistortRectifyMap, remap
 from numpy import ndarray
 from PIL import Image
-from streamlit import set_page_config
-from streamlit.delta_generator import DeltaGenerator
-from streamlit_drawable_canvas import st_canvas
 from supervision import (
   Color,
   ColorLookup,
   ColorPalette,
+  Detections,
   Point,
   Position,
+  draw_text,
 )
 from vidgear.gears import VideoGear
 
+from fish2pano import FisheyeWarping, MeshCache
+
+if TYPE_CHECKING:
+  from streamlit.delta_generator import DeltaGenerator
+
 color_dict = {
   'red': [255, 0, 0],
   'orange': [255, 100, 0],
@@ -35,8 +45,13 @@ color_dict = {
 }
 
 base_colors = ['black', 'white']
-camera_matrix = np.load('fisheye/camera_matrix.npy')
-dist_coeffs = np.load('fisheye/dist_coeffs.npy')
+color_methods = ('mean', 'median', 'kmeans')
+
+
+@cache
+def calibration() -> tuple[ndarray, ndarray]:
+  root = Path(__file__).parent / 'fisheye'
+  return np.load(root / 'camera_matrix.npy'), np.load(root / 'dist_coeffs.npy')
 
 
 class FisheyeFlatten:
@@ -44,10 +59,13 @@ class FisheyeFlatten:
     self,
     reso: tuple[int, int],
     aspect_ratio: float | None = 1.0,
+    fixed_point: bool = True,
+    reuse_buffer: bool = False,
   ):
     w, h = reso
     s = min(w, h)
     d = abs(w - h) // 2
+    camera_matrix, dist_coeffs = calibration()
     self.camera_matrix = camera_matrix
     self.dist_coeffs = dist_coeffs
     self.new_camera_matrix, roi = getOptimalNewCameraMatrix(
@@ -74,36 +92,341 @@ class FisheyeFlatten:
       else ((slice(None), slice(d, d + h)) if w > h else (slice(d, d + w), slice(None)))
     )
 
-  def __call__(self, f: ndarray) -> ndarray:
-    return undistort(
-      f[self.slic],
-      self.camera_matrix,
-      self.dist_coeffs,
+    # maps cover the cropped ROI only, so the principal point moves by the crop origin.
+    # cv2.undistort itself remaps through CV_16SC2 maps, hence the fixed-point default
+    roi_matrix = self.new_camera_matrix.copy()
+    roi_matrix[0, 2] -= left
+    roi_matrix[1, 2] -= top
+    self.map1, self.map2 = initUndistortRectifyMap(
+      camera_matrix,
+      dist_coeffs,
       None,
-      self.new_camera_matrix,
-    )[self.crop]
+      roi_matrix,
+      (right - left, bottom - top),
+      cv2.CV_16SC2 if fixed_point else cv2.CV_32FC1,
+    )
+    self.reuse_buffer = reuse_buffer
+    self.out = None
+
+  def __call__(self, f: ndarray) -> ndarray:
+    out = remap(f[self.slic], self.map1, self.map2, cv2.INTER_LINEAR, dst=self.out)
+    if self.reuse_buffer:
+      self.out = out
+    return out
+
+
+class FisheyePanorama:
+  def __init__(self, cache: MeshCache | None = None, samples: int = 16):
+    self.cache = MeshCache() if cache is None else cache
+    self.samples = samples
+    self.shape = None
+
+  def build(self, shape: tuple[int, ...]):
+    h, w = shape[:2]
+    warping = FisheyeWarping(np.empty((h, w, 3), np.uint8), self.cache)
+    mapx, mapy = warping.build_dewarp_mesh()[1:]
+    if mapx.ndim == 3:
+      mapx, mapy = cv2.convertMaps(mapx, mapy, cv2.CV_32FC1)
+    self.w_d, self.h_d, self.r1, self.r2, self.c_x, self.c_y = warping.get_fisheye_img_data(
+      warping.img
+    )
+
+    # fold the 180 degree `wrap` of `run_dewarp` into the maps
+    rx, ry = np.full_like(mapx, -1), np.full_like(mapy, -1)
+    rx[1:, 1:] = mapx[:0:-1, :0:-1]
+    ry[1:, 1:] = mapy[:0:-1, :0:-1]
+    self.map1, self.map2 = cv2.convertMaps(rx, ry, cv2.CV_16SC2)
+
+    # fisheye pixel -> flat pano index, for gathering masks back
+    dx = np.arange(w) - self.c_x
+    dy = np.arange(h)[:, np.newaxis] - self.c_y
+    theta = np.arctan2(dx, dy) % (2 * np.pi)
+    radius = np.sqrt(dx * dx + dy * dy)
+    # theta near 0 rounds to w_d, which is the same angle as column 0
+    px = np.rint(self.w_d - theta / (2 * np.pi) * self.w_d).astype(np.int64) % self.w_d
+    py = np.rint(self.h_d - (radius - self.r1) / (self.r2 - self.r1) * self.h_d).astype(np.int64)
+    self.valid = (py >= 0) & (py < self.h_d)
+    self.lookup = np.where(self.valid, py * self.w_d + px, 0).ravel()
+    self.shape = shape[:2]
+
+  def __call__(self, f: ndarray) -> ndarray:
+    if f.shape[:2] != self.shape:
+      self.build(f.shape)
+    return remap(f, self.map1, self.map2, cv2.INTER_LINEAR)
+
+  def to_fisheye(self, x: ndarray, y: ndarray) -> tuple[ndarray, ndarray]:
+    r = (self.h_d - y) / self.h_d * (self.r2 - self.r1) + self.r1
+    theta = (self.w_d - x) / self.w_d * 2.0 * np.pi
+    return self.c_x + r * np.sin(theta), self.c_y + r * np.cos(theta)
+
+  def backproject(self, det: Detections) -> Detections:
+    det = copy(det)
+    n = len(det)
+    if not n:
+      return det
+
+    # pano boxes become annular sectors, bound them by points sampled along the edges
+    t = np.linspace(0, 1, self.samples)
+    one = np.ones_like(t)
+    x1, y1, x2, y2 = (det.xyxy[:, i, np.newaxis] for i in range(4))
+    xs = x1 + (x2 - x1) * t
+    ys = y1 + (y2 - y1) * t
+    fx, fy = self.to_fisheye(
+      np.concatenate([xs, xs, x1 * one, x2 * one], axis=1),
+      np.concatenate([y1 * one, y2 * one, ys, ys], axis=1),
+    )
+    h, w = self.shape
+    det.xyxy = np.stack(
+      [
+        np.clip(fx.min(1), 0, w),
+        np.clip(fy.min(1), 0, h),
+        np.clip(fx.max(1), 0, w),
+        np.clip(fy.max(1), 0, h),
+      ],
+      axis=1,
+    )
+
+    if det.mask is not None:
+      mask = det.mask.reshape(n, -1)[:, self.lookup].reshape(n, h, w)
+      det.mask = mask & self.valid
+    return det
+
+
+@lru_cache(maxsize=16)
+def palette_lut(rgb: tuple[tuple[int, int, int], ...], bits: int) -> ndarray:
+  # class of the palette colour nearest to the centre of every quantized RGB cell
+  shift = 8 - bits
+  levels = (np.arange(1 << bits) << shift) + ((1 << shift) >> 1)
+  grid = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)
+  ycc = rgb2ycc(np.array(rgb, np.uint8))
+  lut = np.empty(len(grid), np.uint8)
+  for top in range(0, len(grid), 1 << 16):
+    chunk = rgb2ycc(grid[top : top + (1 << 16)])
+    lut[top : top + (1 << 16)] = np.argmin(
+      np.sum((ycc - chunk[:, np.newaxis]) ** 2, axis=2),
+      axis=1,
+    )
+  lut = lut.reshape((1 << bits,) * 3)
+  lut.setflags(write=False)
+  return lut
 
 
 class ColorClassifier:
-  __slots__ = ('names', 'ycc', 'rgb')
+  __slots__ = ('names', 'ycc', 'rgb', 'lut_bits', 'lut')
 
-  def __init__(self, names: list[str] = base_colors):
+  def __init__(self, names: list[str] = base_colors, lut_bits: int = 0):
     d = {k: v for k, v in color_dict.items() if k in names}
     self.names = list(d.keys())
+    self.lut_bits = lut_bits
+    self.lut = None
 
     if self.names:
       rgb_mat = np.array(list(d.values())).astype(np.uint8)
       self.ycc = rgb2ycc(rgb_mat)
       self.rgb = [tuple(map(int, i)) for i in rgb_mat]
+      if lut_bits:
+        # 0 classifies exactly, otherwise through a 2 ** (3 * lut_bits) table built here,
+        # not on the first frame, and shared by every classifier with the same palette
+        self.lut = palette_lut(tuple(self.rgb), lut_bits)
 
   def closest(self, _rgb: ndarray) -> int:
+    return self.classify(_rgb[np.newaxis])[0]
+
+  def classify(self, rgbs: ndarray) -> ndarray:
+    # any shape ending in RGB, e.g. one colour per box or every pixel of a mask
+    rgbs = np.asarray(rgbs)
+    if self.lut is not None:
+      q = np.clip(np.rint(rgbs), 0, 255).astype(np.uint8) >> (8 - self.lut_bits)
+      return self.lut[q[..., 0], q[..., 1], q[..., 2]]
     return np.argmin(
       np.sum(
-        (self.ycc - rgb2ycc(_rgb[np.newaxis])) ** 2,
-        axis=1,
-      )
+        (self.ycc - rgb2ycc(rgbs.reshape(-1, 3))[:, np.newaxis]) ** 2,
+        axis=2,
+      ),
+      axis=1,
+    ).reshape(rgbs.shape[:-1])
+
+
+class Profiler:
+  # seconds, upper bounds of the cumulative histogram buckets
+  buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+  def __init__(self, window: int = 120):
+    self.window = window
+    self.recent: dict[str, deque] = {}
+    self.counts: dict[str, list[int]] = {}
+    self.sums: dict[str, float] = {}
+    self.lock = Lock()
+
+  def record(self, key: str, seconds: float):
+    with self.lock:
+      if key not in self.recent:
+        self.recent[key] = deque(maxlen=self.window)
+        self.counts[key] = [0] * (len(self.buckets) + 1)
+        self.sums[key] = 0.0
+      self.recent[key].append(seconds)
+      self.counts[key][bisect_left(self.buckets, seconds)] += 1
+      self.sums[key] += seconds
+
+  def wrap(self, key: str, fn: callable) -> callable:
+    record = self.record
+
+    @wraps(fn)
+    def timed(*args, **kwargs):
+      start = perf_counter()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        record(key, perf_counter() - start)
+
+    return timed
+
+  def summary(self) -> dict[str, dict[str, float]]:
+    with self.lock:
+      recent = {k: np.array(v) * 1e3 for k, v in self.recent.items()}
+      counts = {k: sum(v) for k, v in self.counts.items()}
+    return {
+      k: {
+        'count': counts[k],
+        'mean_ms': ms.mean(),
+        'p50_ms': np.percentile(ms, 50),
+        'p90_ms': np.percentile(ms, 90),
+        'p99_ms': np.percentile(ms, 99),
+      }
+      for k, ms in recent.items()
+    }
+
+  def prometheus(self, name: str = 'cvwebui_seconds') -> str:
+    lines = [
+      f'# HELP {name} Wall time of pipeline stages and annotators',
+      f'# TYPE {name} histogram',
+    ]
+    with self.lock:
+      for key, counts in self.counts.items():
+        total = 0
+        for le, c in zip((*self.buckets, '+Inf'), counts):
+          total += c
+          lines.append(f'{name}_bucket{{key="{key}",le="{le}"}} {total}')
+        lines.append(f'{name}_sum{{key="{key}"}} {self.sums[key]}')
+        lines.append(f'{name}_count{{key="{key}"}} {total}')
+    return '\n'.join(lines) + '\n'
+
+  def dump(self, path: str):
+    # written aside and renamed, a textfile collector never reads half a file
+    tmp = Path(f'{path}.tmp')
+    tmp.write_text(self.prometheus())
+    tmp.replace(path)
+
+
+class Timed:
+  # times a preprocessor, anything else (e.g. `backproject`) goes to the wrapped one
+  def __init__(self, fn: callable, profiler: Profiler, key: str):
+    self.fn = fn
+    self.timed = profiler.wrap(key, fn)
+
+  def __call__(self, f: ndarray) -> ndarray:
+    return self.timed(f)
+
+  def __getattr__(self, name: str):
+    return getattr(self.fn, name)
+
+
+class Sprite:
+  __slots__ = ('color', 'dx', 'dy', 'inv', 'opaque')
+
+  def __init__(self, draw: callable, size: tuple[int, int]):
+    # drawn once on black and once on white: the difference gives the coverage,
+    # the black render is the colour premultiplied by it
+    w, h = size
+    anchor = Point(x=w // 2, y=h // 2)
+    black = np.zeros((h, w, 3), np.uint8)
+    white = np.full((h, w, 3), 255, np.uint8)
+    draw(black, anchor)
+    draw(white, anchor)
+    inv = (white.astype(np.int16) - black).max(axis=2).astype(np.uint16)
+    ys, xs = np.nonzero(inv < 255)
+    if not len(ys):
+      ys, xs = np.zeros(1, int), np.zeros(1, int)
+      inv[0, 0] = 255
+    y0, y1, x0, x1 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+    self.color = black[y0:y1, x0:x1]
+    self.inv = inv[y0:y1, x0:x1, np.newaxis]
+    self.opaque = not self.inv.any()
+    self.dx = x0 - anchor.x
+    self.dy = y0 - anchor.y
+
+  def blit(self, scene: ndarray, anchor: Point) -> ndarray:
+    h, w = self.color.shape[:2]
+    x0, y0 = int(anchor.x) + self.dx, int(anchor.y) + self.dy
+    sx0, sy0 = max(x0, 0), max(y0, 0)
+    sx1, sy1 = min(x0 + w, scene.shape[1]), min(y0 + h, scene.shape[0])
+    if sx1 <= sx0 or sy1 <= sy0:
+      return scene
+    src = slice(sy0 - y0, sy1 - y0), slice(sx0 - x0, sx1 - x0)
+    roi = scene[sy0:sy1, sx0:sx1]
+    if self.opaque:
+      roi[:] = self.color[src]
+    else:
+      blend = (roi * self.inv[src] + 127) // 255 + self.color[src]
+      roi[:] = np.minimum(blend, 255)
+    return scene
+
+
+class SpriteCache:
+  def __init__(self, maxsize: int = 256):
+    self.maxsize = maxsize
+    self.sprites: OrderedDict[tuple, Sprite] = OrderedDict()
+
+  def get(self, key: tuple, render: callable) -> Sprite:
+    if (sprite := self.sprites.get(key)) is not None:
+      self.sprites.move_to_end(key)
+      return sprite
+    sprite = self.sprites[key] = render()
+    if len(self.sprites) > self.maxsize:
+      self.sprites.popitem(last=False)
+    return sprite
+
+  def text(
+    self,
+    text: str,
+    text_color: Color = Color.black(),
+    text_scale: float = 0.5,
+    text_thickness: int = 1,
+    text_padding: int = 10,
+    background_color: Color | None = None,
+  ) -> Sprite:
+    key = (
+      text,
+      text_color.as_bgr(),
+      text_scale,
+      text_thickness,
+      text_padding,
+      None if background_color is None else background_color.as_bgr(),
     )
 
+    def render() -> Sprite:
+      def draw(f: ndarray, anchor: Point):
+        draw_text(
+          scene=f,
+          text=text,
+          text_anchor=anchor,
+          text_color=text_color,
+          text_scale=text_scale,
+          text_thickness=text_thickness,
+          text_padding=text_padding,
+          background_color=background_color,
+        )
+
+      return Sprite(draw, text_size(text, text_scale, text_thickness, text_padding))
+
+    return self.get(key, render)
+
+
+def text_size(text: str, scale: float, thickness: int, padding: int) -> tuple[int, int]:
+  # twice the text box, so whatever way it sits around the anchor it fits the canvas
+  (w, h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+  return 2 * (w + 2 * padding) + 4, 2 * (h + baseline + 2 * padding) + 4
+
 
 @define
 class Draw:
@@ -153,6 +476,12 @@ def cvt(f: ndarray) -> ndarray:
   return cv2.cvtColor(f, cv2.COLOR_BGR2RGB)
 
 
+def batched(it: Iterable, n: int) -> Generator[list, None, None]:
+  it = iter(it)
+  while batch := list(islice(it, n)):
+    yield batch
+
+
 def maxcam() -> tuple[int, int]:
   resos = (
     check_output(
@@ -189,7 +518,7 @@ def rgb2ycc(rgb: ndarray) -> ndarray:
 
 def avg_rgb(f: ndarray) -> ndarray:
   return cv2.kmeans(
-    cvt(f.reshape(-1, 3).astype(np.float32)),
+    cvt(f).reshape(-1, 3).astype(np.float32),
     1,
     None,
     (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0),
@@ -198,7 +527,42 @@ def avg_rgb(f: ndarray) -> ndarray:
   )[2][0].astype(np.int32)
 
 
+def box_colors(
+  f: ndarray,
+  xyxy: ndarray,
+  method: str = 'mean',
+  step: int = 4,
+) -> tuple[ndarray, ndarray]:
+  h, w = f.shape[:2]
+  x1, y1, x2, y2 = np.clip(xyxy.astype(int), 0, [w, h, w, h]).T
+  valid = (x2 > x1) & (y2 > y1)
+  rgbs = np.zeros((len(valid), 3), np.float32)
+  if not valid.any():
+    return rgbs, valid
+
+  match method:
+    case 'mean':
+      # k-means with a single cluster converges to the mean,
+      # an integral image gives it for every box at once
+      s = cv2.integral(f, sdepth=cv2.CV_32S if h * w < 1 << 23 else cv2.CV_64F)
+      total = s[y2, x2] - s[y1, x2] - s[y2, x1] + s[y1, x1]
+      area = np.maximum((x2 - x1) * (y2 - y1), 1)[:, np.newaxis]
+      rgbs[:] = (total / area)[:, ::-1]
+    case 'median':
+      for i in np.flatnonzero(valid):
+        crop = f[y1[i] : y2[i] : step, x1[i] : x2[i] : step]
+        rgbs[i] = np.median(crop.reshape(-1, 3), axis=0)[::-1]
+    case 'kmeans':
+      for i in np.flatnonzero(valid):
+        rgbs[i] = avg_rgb(f[y1[i] : y2[i], x1[i] : x2[i]])
+    case _:
+      raise ValueError(f'Unknown color method {method}, expected one of {color_methods}')
+  return rgbs, valid
+
+
 def local_css(file: str):
+  import streamlit as st
+
   with open(file) as f:
     st.markdown(
       f'<style>{f.read()}</style>',
@@ -207,7 +571,9 @@ def local_css(file: str):
 
 
 def st_config():
-  set_page_config(
+  import streamlit as st
+
+  st.set_page_config(
     page_icon='🎥',
     page_title='ComputerVisionWebUI',
     layout='wide',
@@ -263,7 +629,7 @@ def trim_vid(path: str, begin: str, end: str) -> str:
   return trim
 
 
-def filter_by_vals(d: dict, place: DeltaGenerator, text: str) -> list[int | str]:
+def filter_by_vals(d: dict, place: 'DeltaGenerator', text: str) -> list[int | str]:
   a = list(d.values())
 
   if place.toggle(text):
@@ -272,7 +638,7 @@ def filter_by_vals(d: dict, place: DeltaGenerator, text: str) -> list[int | str]
     return list(d.keys())
 
 
-def filter_by_keys(d: dict, place: DeltaGenerator, text: str) -> list[int | str]:
+def filter_by_keys(d: dict, place: 'DeltaGenerator', text: str) -> list[int | str]:
   a = list(d.keys())
 
   if place.toggle(text):
@@ -281,8 +647,10 @@ def filter_by_keys(d: dict, place: DeltaGenerator, text: str) -> list[int | str]
     return a
 
 
-def exe_button(place: DeltaGenerator, text: str, cmd: str):
+def exe_button(place: 'DeltaGenerator', text: str, cmd: str):
   if place.button(text):
+    import streamlit as st
+
     st.code(cmd, language='bash')
     os.system(cmd)
 
@@ -295,6 +663,8 @@ def mycanvas(
   bg: Image.Image,
   key: str,
 ):
+  from streamlit_drawable_canvas import st_canvas
+
   return st_canvas(
     stroke_width=2,
     fill_color='#ffffff55',
@@ -308,6 +678,8 @@ def mycanvas(
 
 
 def canvas2draw(reso, background, is_track):
+  import streamlit as st
+
   width, height = reso
   c1, c2 = st.columns([1, 4])
   mode = c1.selectbox(
@@ -375,6 +747,8 @@ def from_plain(ori: dict):
   for v in d.values():
     for k2, v2 in v.items():
       match k2:
+        case 'color_clf' if isinstance(v2, list):
+          v[k2] = ColorClassifier(v2)
         case str(k2) if 'lookup' in k2:
           v[k2] = ColorLookup(v2)
         case str(k2) if 'position' in k2: